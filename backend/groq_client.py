@@ -0,0 +1,860 @@
+# backend/groq_client.py
+# Groq chat completions: budgets and model fallback, streaming, retries/hedging, reply cache,
+# and parsing the JSON-array replies.
+import os
+import json
+import re
+import asyncio
+import logging
+import random
+import time
+import functools
+import hashlib
+from email.utils import parsedate_to_datetime
+from typing import List, Dict, Any, Callable, Optional, Tuple, NamedTuple
+
+import httpx
+import orjson
+import tiktoken
+from dotenv import load_dotenv
+from utils import LRUCache
+
+load_dotenv()
+
+log = logging.getLogger("learnverse-backend")
+
+# ---- Groq ----
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+# You set this default; fallbacks are below.
+GROQ_MODEL   = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
+GROQ_MAX_TOKENS = int(os.getenv("GROQ_MAX_TOKENS", "6000"))
+
+# Soft local budgets (so we can proactively switch)
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))        # requests per minute
+GROQ_RPD = int(os.getenv("GROQ_RPD", "1000"))      # requests per day
+GROQ_TPM = int(os.getenv("GROQ_TPM", "12000"))     # tokens per minute (in+out)
+GROQ_TPD = int(os.getenv("GROQ_TPD", "100000"))    # tokens per day (in+out)
+
+if not GROQ_API_KEY:
+    raise ValueError("GROQ_API_KEY is missing. Check backend/.env.")
+
+FALLBACK_MODELS = [
+    "llama-3.3-70b-versatile",                         # strong generalist
+    "meta-llama/llama-4-scout-17b-16e-instruct",       # instruction-following
+    "gemma2-9b-it",                                    # reliable JSON
+    "llama-3.1-8b-instant",                            # fast/cheap
+    "deepseek-r1-distill-llama-70b",                   # powerful; emits <think>
+    # "openai/gpt-oss-20b",                            # optional extra backup
+]
+
+# Token-aware input budget. cl100k_base is not the Llama tokenizer, but it tracks it far
+# better than a character count (code/CJK-heavy material tokenizes very differently).
+# ~3000 tokens is the old 12000-character cut, which leaves GROQ_TPM room for a top-up.
+GROQ_MAX_INPUT_TOKENS = int(os.getenv("GROQ_MAX_INPUT_TOKENS", "3000"))
+_WS_RE = re.compile(r"\s+")
+# A token is rarely longer than this many chars, so clipping first keeps us from BPE-encoding
+# a whole textbook just to keep its first few thousand tokens.
+MAX_CHARS_PER_TOKEN = 8
+# Typical English chars per token; the estimate used when the tokenizer is unavailable.
+_AVG_CHARS_PER_TOKEN = 4
+
+# tiktoken downloads cl100k_base on a cold cache with no timeout, so it is loaded off the event
+# loop (warm_encoding at startup). Until it is in, token counts use the character estimate.
+TOKENIZER_LOAD_TIMEOUT_S = float(os.getenv("TOKENIZER_LOAD_TIMEOUT_S", "10"))
+_ENCODING_RETRY_S = 60.0
+_enc = None
+_enc_task: Optional[asyncio.Task] = None
+_enc_last_try = float("-inf")
+
+def _load_encoding() -> None:
+    # Runs in a worker thread; a load that outlives its timeout still lands here when it finishes
+    global _enc
+    _enc = tiktoken.get_encoding("cl100k_base")
+
+async def warm_encoding(timeout: float = TOKENIZER_LOAD_TIMEOUT_S) -> bool:
+    """Load the tokenizer in a thread; False (character estimates for now) if it fails or times out."""
+    global _enc_last_try
+    if _enc is not None:
+        return True
+    _enc_last_try = time.monotonic()
+    try:
+        await asyncio.wait_for(asyncio.to_thread(_load_encoding), timeout)
+    except Exception as e:
+        log.warning("tiktoken encoding unavailable (%r); estimating tokens from characters", e)
+        return False
+    return True
+
+def _encoding():
+    """
+    The loaded encoding, or None. A failed load is not remembered: while it is missing, a
+    background retry is started at most once every _ENCODING_RETRY_S.
+    """
+    global _enc_task
+    if _enc is None and (_enc_task is None or _enc_task.done()) \
+            and time.monotonic() - _enc_last_try >= _ENCODING_RETRY_S:
+        try:
+            _enc_task = asyncio.get_running_loop().create_task(warm_encoding())
+        except RuntimeError:
+            pass  # no loop (scripts/tests): stay on the estimate
+    return _enc
+
+def _token_len(text: str) -> int:
+    enc = _encoding()
+    if enc is None:
+        return -(-len(text) // _AVG_CHARS_PER_TOKEN)
+    return len(enc.encode(text, disallowed_special=()))
+
+def truncate_text(text: str, max_tokens: int = GROQ_MAX_INPUT_TOKENS) -> str:
+    text = _WS_RE.sub(" ", text[: max_tokens * MAX_CHARS_PER_TOKEN]).strip()
+    enc = _encoding()
+    if enc is None:
+        return text[: max_tokens * _AVG_CHARS_PER_TOKEN]
+    ids = enc.encode(text, disallowed_special=())
+    return text if len(ids) <= max_tokens else enc.decode(ids[:max_tokens])
+
+# ---- Groq helpers ----
+GROQ_BASE_URL = "https://api.groq.com"
+GROQ_CHAT_PATH = "/openai/v1/chat/completions"
+GROQ_TEMPERATURE = 0.1
+GRADE_TEMPERATURE = 0.0  # TRUE/FALSE verdicts should not vary between identical calls
+GROQ_TIMEOUT_S = 75
+GROQ_CONNECT_TIMEOUT_S = 3.05
+GROQ_CONNECT_RETRIES = 2
+
+# Shared async client: keeps TCP/TLS connections alive across calls and never blocks the event loop.
+# Auth/content-type are client defaults so each call only supplies the body.
+# The transport retries failed connection attempts only (nothing was sent, so a POST is safe to
+# repeat); HTTP-level 429/5xx handling stays in _call_with_fallback, which knows about budgets.
+GROQ_CLIENT = httpx.AsyncClient(
+    base_url=GROQ_BASE_URL,
+    headers={"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"},
+    timeout=httpx.Timeout(GROQ_TIMEOUT_S, connect=GROQ_CONNECT_TIMEOUT_S),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=GROQ_CONNECT_RETRIES,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    ),
+)
+
+class GroqReply(NamedTuple):
+    status_code: int
+    content: str                   # assistant text (200 only)
+    total_tokens: Optional[int]    # provider-reported usage, when it arrived
+    error: Dict[str, Any]          # parsed error body (non-200 only)
+    headers: httpx.Headers
+
+def _error_body(raw: bytes, status_code: int) -> Dict[str, Any]:
+    try: return orjson.loads(raw)
+    except Exception: return {"error": {"message": raw.decode("utf-8", "replace"), "code": str(status_code)}}
+
+# Per-attempt predicate over each completed array element (its JSON text); True ends the stream.
+ItemCheck = Callable[[str], bool]
+
+async def _post_to_groq(
+    model: str, prompt: str, max_tokens: int, system: Optional[str] = None,
+    started: Optional[asyncio.Event] = None, item_check: Optional[ItemCheck] = None,
+    temperature: float = GROQ_TEMPERATURE,
+) -> GroqReply:
+    """
+    Streams the completion (SSE) and stops reading as soon as the top-level JSON array
+    has closed, instead of idling until the whole body has been generated and sent.
+    `started` (if given) is set once the provider has answered with a status line.
+    `item_check` (if given) sees each array element as it completes; once it returns True
+    the reply is cut after that element and the array closed, skipping the rest.
+    """
+    data = {
+        "model": model,
+        "messages": ([{"role": "system", "content": system}] if system else []) + [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+        "top_p": 1.0,
+        "max_tokens": max_tokens,
+        "stop": ["```", "<think>", "</think>"],
+        "stream": True,
+    }
+    async with GROQ_CLIENT.stream("POST", GROQ_CHAT_PATH, content=orjson.dumps(data)) as r:
+        if started is not None:
+            started.set()
+        if r.status_code != 200:
+            return GroqReply(r.status_code, "", None, _error_body(await r.aread(), r.status_code), r.headers)
+
+        parts: List[str] = []
+        scanner = _ArrayScanner(collect_items=item_check is not None)
+        total_tokens = None
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            event = orjson.loads(payload)
+            if event.get("error"):
+                # Mid-stream provider failure; surface it like a transient 5xx
+                return GroqReply(500, "", None, {"error": event["error"]}, r.headers)
+            usage = (event.get("x_groq") or {}).get("usage") or event.get("usage")
+            if usage:
+                total_tokens = _parse_usage_total_tokens({"usage": usage})
+            for choice in event.get("choices") or ():
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    done = scanner.feed(delta)
+                    if scanner.items:
+                        items, scanner.items = scanner.items, []
+                        for item, tail in items:
+                            if item_check(item):
+                                if tail:
+                                    parts[-1] = delta[:-tail]
+                                parts.append("]")
+                                return GroqReply(200, "".join(parts), total_tokens, {}, r.headers)
+                    if done:
+                        # Array complete: stop reading and drop whatever followed it in this chunk.
+                        if scanner.tail:
+                            parts[-1] = delta[:-scanner.tail]
+                        return GroqReply(200, "".join(parts), total_tokens, {}, r.headers)
+        return GroqReply(200, "".join(parts), total_tokens, {}, r.headers)
+
+# ---------- Simple in-memory rate limiter + model cooldowns ----------
+# With REDIS_URL set, budgets are shared by every worker/instance (see RedisRateLimiter).
+REDIS_URL = os.getenv("REDIS_URL")
+
+# A request that would fit the per-minute budget within this many seconds waits for the
+# refill instead of being refused.
+GROQ_BUCKET_MAX_WAIT_S = float(os.getenv("GROQ_BUCKET_MAX_WAIT_S", "2"))
+
+class RateLimiter:
+    """
+    Global soft budgets to avoid hammering the API.
+    Per-minute budgets are token buckets refilled continuously (rpm/60 requests and tpm/60
+    tokens per second), so there is no burst-then-stall at minute boundaries. Daily budgets
+    are fixed UTC-day windows, matching the provider's reset.
+    """
+    def __init__(self, rpm:int, rpd:int, tpm:int, tpd:int):
+        self.rpm_limit = rpm
+        self.rpd_limit = rpd
+        self.tpm_limit = tpm
+        self.tpd_limit = tpd
+        self._req_bucket = float(rpm)
+        self._tok_bucket = float(tpm)
+        self._refilled_at = time.monotonic()
+        self._day_epoch = self._now_day()
+        self.rpd_used = 0
+        self.tpd_used = 0
+        # Model cooldowns: model -> unix timestamp
+        self.model_cooldown_until: Dict[str, float] = {}
+        # Serializes check-and-reserve across concurrent requests
+        self._lock = asyncio.Lock()
+
+    def _now_minute(self) -> int:
+        return int(time.time() // 60)
+
+    def _now_day(self) -> int:
+        return int(time.time() // 86400)
+
+    def _refresh(self):
+        now = time.monotonic()
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._req_bucket = min(self.rpm_limit, self._req_bucket + elapsed * self.rpm_limit / 60)
+        self._tok_bucket = min(self.tpm_limit, self._tok_bucket + elapsed * self.tpm_limit / 60)
+        cur_day = self._now_day()
+        if cur_day != self._day_epoch:
+            self._day_epoch = cur_day
+            self.rpd_used = 0
+            self.tpd_used = 0
+
+    def is_model_on_cooldown(self, model: str) -> bool:
+        until = self.model_cooldown_until.get(model, 0)
+        return until and time.time() < until
+
+    def set_cooldown(self, model: str, seconds: float):
+        self.model_cooldown_until[model] = max(self.model_cooldown_until.get(model, 0), time.time() + seconds)
+
+    def can_afford(self, req_tokens_est:int = 0, requests: int = 1) -> Tuple[bool, str]:
+        self._refresh()
+        if self._req_bucket < requests:
+            return False, "rpm_exhausted"
+        if self.rpd_used + requests > self.rpd_limit:
+            return False, "rpd_exhausted"
+        if self._tok_bucket < req_tokens_est:
+            return False, "tpm_exhausted"
+        if self.tpd_used + req_tokens_est > self.tpd_limit:
+            return False, "tpd_exhausted"
+        return True, ""
+
+    def _minute_wait(self, req_tokens_est: int) -> float:
+        """Seconds until both buckets hold enough for this request (inf if they never will)."""
+        if req_tokens_est > self.tpm_limit:
+            return float("inf")
+        return max(
+            0.0,
+            (1 - self._req_bucket) * 60 / self.rpm_limit,
+            (req_tokens_est - self._tok_bucket) * 60 / self.tpm_limit,
+        )
+
+    async def try_reserve(self, req_tokens_est:int = 0, max_wait_s: Optional[float] = None) -> Tuple[bool, str]:
+        """
+        Atomic check-and-reserve: two requests can't both pass the check for the last slot.
+        Waits when the per-minute buckets refill within max_wait_s (default
+        GROQ_BUCKET_MAX_WAIT_S; 0 never waits). The lock is released while sleeping, so a large
+        reservation waiting for tokens doesn't hold up small ones; it re-checks on waking.
+        """
+        if max_wait_s is None:
+            max_wait_s = GROQ_BUCKET_MAX_WAIT_S
+        deadline = time.monotonic() + max_wait_s
+        while True:
+            async with self._lock:
+                ok, reason = self.can_afford(req_tokens_est)
+                if ok:
+                    self._req_bucket -= 1
+                    self._tok_bucket -= req_tokens_est
+                    self.rpd_used += 1
+                    self.tpd_used += req_tokens_est
+                    return ok, reason
+                if reason not in ("rpm_exhausted", "tpm_exhausted"):
+                    return ok, reason
+                wait = self._minute_wait(req_tokens_est)
+                if wait > deadline - time.monotonic():
+                    return ok, reason
+            await asyncio.sleep(wait)
+
+    def adjust_after_response(self, est_reserved:int, actual_total_tokens:int):
+        """
+        Adjust token counters to the actual usage; allow negative delta.
+        """
+        self._refresh()
+        delta = actual_total_tokens - est_reserved
+        # Overspend leaves the bucket in debt; it refills like any other deficit
+        self._tok_bucket = min(self.tpm_limit, self._tok_bucket - delta)
+        self.tpd_used = max(0, self.tpd_used + delta)
+
+    def note_rate_limited(self):
+        """
+        The provider answered 429 although we thought there was budget: drain one second of
+        refill so our bucket doesn't keep running ahead of theirs.
+        """
+        self._refresh()
+        self._tok_bucket -= self.tpm_limit / 60
+
+class RedisRateLimiter(RateLimiter):
+    """
+    Same budgets, but the counters live in Redis so every worker/instance draws from one pool.
+    Shared minute budgets are fixed windows (INCR + EXPIRE) rather than buckets.
+    Cooldowns stay per process; a worker that hits a 429 finds out on its own.
+    """
+    _RESERVE_LUA = """
+    local used = {}
+    for i = 1, 4 do used[i] = tonumber(redis.call('GET', KEYS[i]) or '0') end
+    local est = tonumber(ARGV[1])
+    local need = {1, 1, est, est}
+    for i = 1, 4 do
+        if used[i] + need[i] > tonumber(ARGV[1 + i]) then return {i, used[1], used[2], used[3], used[4]} end
+    end
+    for i = 1, 4 do
+        used[i] = redis.call('INCRBY', KEYS[i], need[i])
+        redis.call('EXPIRE', KEYS[i], ARGV[(i % 2 == 1) and 6 or 7])
+    end
+    return {0, used[1], used[2], used[3], used[4]}
+    """
+    # Token deltas are clamped at 0 so a refund landing in a fresh window can't create credit.
+    _ADJUST_LUA = """
+    for i = 1, 2 do
+        if redis.call('INCRBY', KEYS[i], ARGV[1]) < 0 then redis.call('SET', KEYS[i], 0) end
+        redis.call('EXPIRE', KEYS[i], ARGV[1 + i])
+    end
+    """
+    _REASONS = ("", "rpm_exhausted", "rpd_exhausted", "tpm_exhausted", "tpd_exhausted")
+    _MINUTE_TTL_S = 120
+    _DAY_TTL_S = 2 * 86400
+
+    def __init__(self, url: str, rpm:int, rpd:int, tpm:int, tpd:int):
+        super().__init__(rpm, rpd, tpm, tpd)
+        # Local mirror of the shared counters, for the synchronous can_afford() probe
+        self._minute_epoch = self._now_minute()
+        self.rpm_used = 0
+        self.tpm_used = 0
+        import redis.asyncio as aioredis
+        self.redis = aioredis.from_url(url)
+        self._reserve = self.redis.register_script(self._RESERVE_LUA)
+        self._adjust = self.redis.register_script(self._ADJUST_LUA)
+        self._pending: set = set()
+
+    def _refresh(self):
+        super()._refresh()
+        cur_min = self._now_minute()
+        if cur_min != self._minute_epoch:
+            self._minute_epoch = cur_min
+            self.rpm_used = 0
+            self.tpm_used = 0
+
+    def can_afford(self, req_tokens_est:int = 0, requests: int = 1) -> Tuple[bool, str]:
+        self._refresh()
+        if self.rpm_used + requests > self.rpm_limit:
+            return False, "rpm_exhausted"
+        if self.rpd_used + requests > self.rpd_limit:
+            return False, "rpd_exhausted"
+        if self.tpm_used + req_tokens_est > self.tpm_limit:
+            return False, "tpm_exhausted"
+        if self.tpd_used + req_tokens_est > self.tpd_limit:
+            return False, "tpd_exhausted"
+        return True, ""
+
+    def _keys(self) -> Tuple[str, str, str, str]:
+        m, d = self._now_minute(), self._now_day()
+        return f"groq:rpm:{m}", f"groq:rpd:{d}", f"groq:tpm:{m}", f"groq:tpd:{d}"
+
+    async def try_reserve(self, req_tokens_est:int = 0, max_wait_s: Optional[float] = None) -> Tuple[bool, str]:
+        res = await self._reserve(
+            keys=self._keys(),
+            args=[req_tokens_est, self.rpm_limit, self.rpd_limit, self.tpm_limit, self.tpd_limit,
+                  self._MINUTE_TTL_S, self._DAY_TTL_S],
+        )
+        self._refresh()
+        self.rpm_used, self.rpd_used, self.tpm_used, self.tpd_used = (int(v) for v in res[1:])
+        return res[0] == 0, self._REASONS[res[0]]
+
+    def adjust_after_response(self, est_reserved:int, actual_total_tokens:int):
+        self._refresh()
+        delta = actual_total_tokens - est_reserved
+        if not delta:
+            return
+        self.tpm_used = max(0, self.tpm_used + delta)
+        self.tpd_used = max(0, self.tpd_used + delta)
+        _, _, tpm_key, tpd_key = self._keys()
+        # Fire-and-forget: callers run this from cleanup paths (even during cancellation).
+        task = asyncio.get_running_loop().create_task(
+            self._adjust(keys=[tpm_key, tpd_key], args=[delta, self._MINUTE_TTL_S, self._DAY_TTL_S])
+        )
+        self._pending.add(task)
+        task.add_done_callback(self._adjust_done)
+
+    def _adjust_done(self, task: asyncio.Task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.warning("Shared token budget adjustment failed: %s", task.exception())
+
+    def note_rate_limited(self):
+        pass  # the shared window is already the source of truth
+
+if REDIS_URL:
+    limiter: RateLimiter = RedisRateLimiter(REDIS_URL, GROQ_RPM, GROQ_RPD, GROQ_TPM, GROQ_TPD)
+else:
+    limiter = RateLimiter(GROQ_RPM, GROQ_RPD, GROQ_TPM, GROQ_TPD)
+
+# Keyed on the string itself (str caches its hash): the system prompt and retried/top-up
+# prompts are counted once instead of re-encoded on every call.
+@functools.lru_cache(maxsize=128)
+def _count_tokens(text: str) -> int:
+    return max(1, _token_len(text))
+
+def _estimate_tokens_for_request(in_tokens:int, out_tokens_cap:int) -> int:
+    # exact input count; be less pessimistic (50% of output cap) to reduce over-reserving
+    out_tokens = max(1, int(out_tokens_cap * 0.5))
+    return in_tokens + out_tokens
+
+def estimate_call_tokens(prompt: str, max_tokens_override: Optional[int] = None, system: Optional[str] = None) -> int:
+    """What call_groq would reserve for these arguments."""
+    out_cap = max_tokens_override if max_tokens_override is not None else GROQ_MAX_TOKENS
+    return _estimate_tokens_for_request(_count_tokens(system or "") + _count_tokens(prompt), out_cap)
+
+def _parse_usage_total_tokens(resp_json: Dict[str, Any]) -> Optional[int]:
+    try:
+        usage = resp_json.get("usage") or {}
+        total = usage.get("total_tokens")
+        if isinstance(total, int) and total > 0:
+            return total
+        parts = (usage.get("prompt_tokens"), usage.get("completion_tokens"))
+        if all(isinstance(p, int) for p in parts) and sum(parts) > 0:
+            return sum(parts)
+    except Exception:
+        pass
+    return None
+
+# Preferred model first, then the fallbacks, without duplicates.
+MODEL_ORDER: Tuple[str, ...] = tuple(dict.fromkeys([GROQ_MODEL] + FALLBACK_MODELS))
+
+def choose_model(est: int) -> Optional[str]:
+    """
+    Pick the first model we can afford (for an estimated token reservation) and that's not on cooldown.
+    """
+    for model in MODEL_ORDER:
+        if limiter.is_model_on_cooldown(model):
+            log.warning("Model %s is on cooldown; skipping.", model)
+            continue
+        ok, reason = limiter.can_afford(est)
+        if ok:
+            return model
+        log.warning("Local budget near/over limit (%s); trying fallback model.", reason)
+    return None  # none affordable right now
+
+# Provider error helpers
+_QUOTA_HINTS = ("quota", "daily", "exceed", "exceeded", "limit", "insufficient", "tpm", "rpm", "tpd", "rpd", "rate")
+def _looks_like_quota_or_rate(err_json: Dict[str, Any]) -> Tuple[bool, str]:
+    msg = ""
+    try:
+        e = err_json.get("error") or {}
+        msg = (e.get("message") or "") + " " + (e.get("code") or "")
+        msg = msg.lower()
+    except Exception:
+        pass
+    hit = any(k in msg for k in _QUOTA_HINTS)
+    return hit, msg
+
+# Retry policy: transient 5xx/transport errors back off exponentially (with jitter) on the same
+# model; quota/rate errors and decommissioned models fall through to the next model at once.
+GROQ_TRANSIENT_RETRIES = 2
+GROQ_BACKOFF_BASE_S = 0.5
+GROQ_DEADLINE_S = float(os.getenv("GROQ_DEADLINE_S", "120"))  # wall-clock cap for one call_groq
+
+GROQ_BACKOFF_CAP_S = 8.0  # longer server-requested waits go to the next model instead
+
+def _backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    # Jitter keeps concurrent requests that failed together from retrying in lockstep.
+    base = retry_after if retry_after is not None else min(GROQ_BACKOFF_CAP_S, GROQ_BACKOFF_BASE_S * (2 ** attempt))
+    return base + random.uniform(0, 0.25)
+
+def _retry_after_seconds(headers: httpx.Headers) -> Optional[float]:
+    """Retry-After as seconds; accepts both delta-seconds and HTTP-date forms."""
+    val = headers.get("retry-after")
+    if not val:
+        return None
+    try:
+        return max(0.0, float(val))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(val).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+async def _post_attempt(
+    model: str, prompt: str, out_cap: int, system: Optional[str],
+    make_item_check: Optional[Callable[[], ItemCheck]] = None, started: Optional[asyncio.Event] = None,
+    temperature: float = GROQ_TEMPERATURE,
+) -> GroqReply:
+    try:
+        return await _post_to_groq(
+            model, prompt, max_tokens=out_cap, system=system, started=started,
+            item_check=make_item_check() if make_item_check else None, temperature=temperature,
+        )
+    except httpx.TransportError as e:
+        return GroqReply(503, "", None, {"error": {"message": f"{type(e).__name__}: {e}", "code": "transport"}}, httpx.Headers())
+
+# Hedging: if a model hasn't even started answering after GROQ_HEDGE_S (a healthy stream starts
+# well under a second), race the next affordable fallback against it. 0 disables hedging.
+GROQ_HEDGE_S = float(os.getenv("GROQ_HEDGE_S", "2.5"))
+
+async def _reserve_hedge_model(candidates: List[str], estimate: int) -> Optional[str]:
+    for m in candidates:
+        if limiter.is_model_on_cooldown(m):
+            continue
+        # Only hedge on spare budget: waiting for a refill would defeat the point of hedging
+        ok, _ = await limiter.try_reserve(estimate, max_wait_s=0)
+        return m if ok else None  # budgets are global: if one can't be afforded, none can
+    return None
+
+async def _post_with_hedge(
+    model: str, hedge_candidates: List[str],
+    prompt: str, system: Optional[str], out_cap: int, in_tokens: int, estimate: int,
+    make_item_check: Optional[Callable[[], ItemCheck]] = None, temperature: float = GROQ_TEMPERATURE,
+) -> Tuple[str, GroqReply]:
+    """
+    Returns (model that answered, reply). The caller has already reserved budget for `model`;
+    a hedge reserves its own, and whichever request is not returned gets released here.
+    """
+    started = asyncio.Event()
+    primary = asyncio.create_task(_post_attempt(model, prompt, out_cap, system, make_item_check, started, temperature))
+    if GROQ_HEDGE_S <= 0:
+        return model, await primary
+
+    waiter = asyncio.create_task(started.wait())
+    try:
+        await asyncio.wait({primary, waiter}, timeout=GROQ_HEDGE_S, return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        primary.cancel()
+        raise
+    finally:
+        waiter.cancel()
+    hedge_model = None
+    if not (started.is_set() or primary.done()):
+        hedge_model = await _reserve_hedge_model(hedge_candidates, estimate)
+    if hedge_model is None:
+        try:
+            return model, await primary
+        except BaseException:
+            primary.cancel()
+            raise
+
+    log.warning("No response from %s after %.1fs; hedging with %s", model, GROQ_HEDGE_S, hedge_model)
+    hedge = asyncio.create_task(_post_attempt(hedge_model, prompt, out_cap, system, make_item_check, temperature=temperature))
+    winner = None
+    try:
+        pending = {primary, hedge}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((t for t in done if t.result().status_code == 200), None)
+    finally:
+        for t in (primary, hedge):
+            if not t.done():
+                t.cancel()
+        # Nobody succeeded (or we were cancelled): report the primary, as if there had been no hedge
+        reported = winner or primary
+        limiter.adjust_after_response(estimate, in_tokens)  # release the request we don't report
+    return (hedge_model if reported is hedge else model), reported.result()
+
+async def _call_with_fallback(
+    prompt: str, system: Optional[str], out_cap: int, in_tokens: int, estimate: int, models_to_try: List[str],
+    make_item_check: Optional[Callable[[], ItemCheck]] = None, temperature: float = GROQ_TEMPERATURE,
+) -> str:
+    release = in_tokens  # request tokens only, used when an attempt fails
+    last_error = None
+
+    for idx, model in enumerate(models_to_try):
+        if limiter.is_model_on_cooldown(model):
+            log.warning("Model %s still on cooldown; skipping.", model)
+            continue
+
+        for attempt in range(GROQ_TRANSIENT_RETRIES + 1):
+            can, reason = await limiter.try_reserve(estimate)
+            if not can:
+                log.warning("Skipping %s due to local budgets: %s", model, reason)
+                break
+
+            log.info("Calling Groq model=%s attempt=%d (reserved est=%d tokens)", model, attempt + 1, estimate)
+            try:
+                answered, r = await _post_with_hedge(
+                    model, models_to_try[idx + 1:], prompt, system, out_cap, in_tokens, estimate,
+                    make_item_check, temperature,
+                )
+            except BaseException:
+                # Cancelled (deadline/client gone) mid-request: don't leave the reservation hanging
+                limiter.adjust_after_response(estimate, release)
+                raise
+
+            if r.status_code == 200:
+                # Streams we cut short never see the final usage event: count what we received
+                used = r.total_tokens or in_tokens + _token_len(r.content)
+                limiter.adjust_after_response(estimate, used)
+                log.info("Groq OK model=%s tokens_used=%s", answered, used)
+                return r.content
+
+            # Not 200 -> inspect
+            err = r.error
+            last_error = (r.status_code, err)
+            log.error("[GROQ ERROR] model=%s %s %s", model, r.status_code, err)
+
+            # Always release reservation with a small usage (assume request tokens only) to avoid overhang
+            limiter.adjust_after_response(estimate, actual_total_tokens=release)
+
+            code_lower = ""
+            try:
+                code_lower = str(err.get("error", {}).get("code", "")).lower()
+            except Exception:
+                pass
+            msg_hit, msg_text = _looks_like_quota_or_rate(err)
+
+            # Retired model: no point retrying it today.
+            if "decommission" in code_lower or "decommission" in msg_text:
+                limiter.set_cooldown(model, seconds=24*3600)
+                log.warning("Model %s is decommissioned; skipping it for 24h.", model)
+                break
+
+            # If the provider hints quota/rate, cooldown this model so next attempts try fallbacks.
+            if r.status_code in (429, 403) or msg_hit or any(k in code_lower for k in _QUOTA_HINTS):
+                if r.status_code == 429:
+                    limiter.note_rate_limited()
+                retry_after = _retry_after_seconds(r.headers)
+                if retry_after is not None:
+                    limiter.set_cooldown(model, seconds=retry_after)
+                    log.warning("Cooldown set: %s for %.1fs per Retry-After.", model, retry_after)
+                # TPM/RPM -> short cooldown; Daily quota -> longer cooldown
+                elif any(k in msg_text for k in ("tpm", "rpm", "rate")):
+                    limiter.set_cooldown(model, seconds=60)        # 1 minute
+                    log.warning("Cooldown set: %s for 60s due to rate/TPM.", model)
+                elif any(k in msg_text for k in ("daily", "tpd", "rpd", "quota", "insufficient", "exceed", "exceeded", "limit")):
+                    limiter.set_cooldown(model, seconds=6*3600)    # 6 hours
+                    log.warning("Cooldown set: %s for 6h due to daily/quota.", model)
+                # Try next model immediately
+                break
+
+            # Transient 5xx -> jittered exponential backoff with the same model, then next
+            if r.status_code in (500, 502, 503, 504):
+                retry_after = _retry_after_seconds(r.headers)
+                if retry_after is not None and retry_after > GROQ_BACKOFF_CAP_S:
+                    limiter.set_cooldown(model, seconds=retry_after)
+                    log.warning("Cooldown set: %s for %.1fs per Retry-After.", model, retry_after)
+                    break
+                if attempt < GROQ_TRANSIENT_RETRIES:
+                    delay = _backoff_delay(attempt, retry_after)
+                    log.warning("Transient %s; retrying model=%s after %.2fs", r.status_code, model, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                log.warning("Switching model after transient issue.")
+                break
+
+            # Other client errors: try next model
+            log.warning("Unhandled error for model=%s; trying next model.", model)
+            break
+
+    status, err = last_error if last_error else (500, {"error": "Unknown Groq failure"})
+    raise RuntimeError(f"Groq {status}: {err}")
+
+# Reply cache for call_groq, keyed on everything that shapes the completion except the model
+# (whichever model in MODEL_ORDER answered, its reply is acceptable for the same request).
+# Only replies the caller's cache_if accepts are stored: a reply that failed parsing or came
+# up short must not be replayed to the retry, which needs a fresh sample.
+# GROQ_CACHE_MODE: enabled (read+write) | read_only | replay (read; a miss is an error, so
+# test runs spend no quota) | disabled.
+GROQ_CACHE_MODE = os.getenv("GROQ_CACHE_MODE", "enabled").lower()
+GROQ_REPLY_CACHE = LRUCache(int(os.getenv("GROQ_CACHE_SIZE", "512")), ttl_s=float(os.getenv("GROQ_CACHE_TTL_S", "86400")))
+
+def _groq_cache_key(system: Optional[str], prompt: str, max_tokens: int, temperature: float = GROQ_TEMPERATURE) -> str:
+    h = hashlib.sha256(f"{temperature}|{max_tokens}|".encode())
+    h.update((system or "").encode())
+    h.update(b"\0")
+    h.update(prompt.encode())
+    return h.hexdigest()
+
+async def call_groq(
+    prompt: str, max_tokens_override: Optional[int] = None, system: Optional[str] = None,
+    make_item_check: Optional[Callable[[], ItemCheck]] = None, temperature: float = GROQ_TEMPERATURE,
+    cache_if: Optional[Callable[[str], bool]] = None,
+) -> str:
+    """
+    Budget-aware call with optional small max_tokens for top-up and optional system message.
+    - Releases unused reservations (fixes false TPM exhaustion).
+    - Skips models on cooldown and sets cooldowns on provider quota/rate errors.
+    - Bounded by GROQ_DEADLINE_S overall, however many models/retries that takes.
+    - make_item_check (optional) builds a fresh ItemCheck per attempt, so a JSON-array reply
+      can end as soon as it holds enough items.
+    - cache_if (optional) decides whether the reply is usable enough to cache; without it
+      the reply is never written to GROQ_REPLY_CACHE.
+    """
+    out_cap = max_tokens_override if max_tokens_override is not None else GROQ_MAX_TOKENS
+    in_tokens = _count_tokens(system or "") + _count_tokens(prompt)
+    estimate = _estimate_tokens_for_request(in_tokens, out_cap)
+
+    first = choose_model(estimate)
+    models_to_try = [first] + [m for m in MODEL_ORDER if m != first] if first else list(MODEL_ORDER)
+
+    if not models_to_try:
+        # Nothing affordable now; surface a clear error
+        raise RuntimeError("Local budgets exhausted; please retry shortly.")
+
+    cache_key = _groq_cache_key(system, prompt, out_cap, temperature)
+    if GROQ_CACHE_MODE != "disabled":
+        hit = GROQ_REPLY_CACHE.get(cache_key)
+        if hit is not None:
+            return hit
+        if GROQ_CACHE_MODE == "replay":
+            raise RuntimeError("No cached Groq reply for this prompt (GROQ_CACHE_MODE=replay).")
+
+    try:
+        content = await asyncio.wait_for(
+            _call_with_fallback(
+                prompt, system, out_cap, in_tokens, estimate, models_to_try, make_item_check, temperature
+            ),
+            timeout=GROQ_DEADLINE_S,
+        )
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"Groq did not answer within {GROQ_DEADLINE_S:.0f}s; please retry shortly.")
+    if GROQ_CACHE_MODE == "enabled" and cache_if is not None and cache_if(content):
+        GROQ_REPLY_CACHE.set(cache_key, content)
+    return content
+
+# -------- Output sanitization & parsing --------
+class _ArrayScanner:
+    """
+    Incremental bracket matcher that ignores brackets inside JSON string literals.
+    feed() returns True once the first top-level array has closed; `tail` is then the number
+    of characters of the last chunk that came after the closing bracket.
+    With collect_items=True, every completed top-level element that is an object/array is
+    appended to `items` as (json_text, tail) -- tail again counting the rest of that chunk.
+    """
+    __slots__ = ("depth", "in_str", "esc", "done", "tail", "collect", "items", "_item_parts", "_capturing")
+
+    def __init__(self, collect_items: bool = False):
+        self.depth = 0
+        self.in_str = False
+        self.esc = False
+        self.done = False
+        self.tail = 0
+        self.collect = collect_items
+        self.items: List[Tuple[str, int]] = []
+        self._item_parts: List[str] = []
+        self._capturing = False
+
+    def feed(self, chunk: str) -> bool:
+        if self.done:
+            return True
+        depth, in_str, esc = self.depth, self.in_str, self.esc
+        start = 0  # where the element being captured begins within this chunk
+        for i, ch in enumerate(chunk):
+            if in_str:
+                if esc: esc = False
+                elif ch == "\\": esc = True
+                elif ch == '"': in_str = False
+            elif ch == '"':
+                # Quotes only open strings inside the array; stray prose quotes are ignored.
+                if depth: in_str = True
+            elif ch == "[" or (ch == "{" and depth):
+                if depth == 1 and self.collect:
+                    self._capturing, start = True, i
+                depth += 1
+            elif (ch == "]" or ch == "}") and depth:
+                depth -= 1
+                if depth == 1 and self._capturing:
+                    self._item_parts.append(chunk[start:i + 1])
+                    self.items.append(("".join(self._item_parts), len(chunk) - i - 1))
+                    self._item_parts, self._capturing = [], False
+                elif depth == 0:
+                    self.done = True
+                    self.tail = len(chunk) - i - 1
+                    break
+        if self._capturing:
+            self._item_parts.append(chunk[start:])
+        self.depth, self.in_str, self.esc = depth, in_str, esc
+        return self.done
+
+_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL | re.IGNORECASE)
+# One pass: either a whole <think> block (skipped) or a code fence (group 1 = payload).
+_CLEAN_RE = re.compile(r"<think>.*?</think>|```(?:json)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+_CLEAN_STRIP = "`\ufeff \n\r\t"
+
+def clean_model_output(text: str) -> str:
+    saw_think = False
+    for m in _CLEAN_RE.finditer(text):
+        if m.group(1) is not None:
+            return m.group(1).strip(_CLEAN_STRIP)
+        saw_think = True
+    if saw_think:
+        text = _THINK_RE.sub("", text)
+    return text.strip(_CLEAN_STRIP)
+
+# Last resort (e.g. an unterminated array): raw_decode reports where parsing failed.
+_JSON_DECODER = json.JSONDecoder()
+
+def extract_json_array(text: str):
+    # Streamed replies are normally cut right after the array: parse those without the regex pass.
+    bare = text.strip()
+    if bare[:1] == "[" and bare[-1:] == "]":
+        try:
+            return orjson.loads(bare)
+        except orjson.JSONDecodeError:
+            pass
+    text = clean_model_output(text)
+    start = text.find("[")
+    if start == -1:
+        raise ValueError("No valid JSON array found in output.")
+    # One string-aware pass finds the matching "]" (brackets inside question text and any
+    # bracketed chatter after the array are skipped), then orjson parses just that slice.
+    scanner = _ArrayScanner()
+    if scanner.feed(text[start:]):
+        try:
+            return orjson.loads(text[start:len(text) - scanner.tail])
+        except orjson.JSONDecodeError:
+            pass
+    try:
+        arr, _ = _JSON_DECODER.raw_decode(text, start)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Failed to parse JSON array: {e}")
+    return arr
@@ -0,0 +1,25 @@
+# backend/logging_setup.py
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+
+def start_queue_logging(level: int = logging.INFO, stream: Optional[TextIO] = None) -> QueueListener:
+    """
+    Route root logging through a queue so the stderr write happens on the listener thread.
+    QueueHandler.prepare() still renders the message on the calling thread, so that handler
+    formats only "%(message)s"; the asctime/level prefix is added once, by the listener.
+    Returns the started listener; stop() it on shutdown to flush what is still queued.
+    """
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    logging.basicConfig(level=level, handlers=[queue_handler], force=True)
+    listener.start()
+    return listener
@@ -1,53 +1,40 @@
 # backend/main.py
 import os
-import uuid
-import json
 import re
-import requests
+import asyncio
 import logging
-import time
-import difflib
-from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
+import functools
+import hashlib
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Callable, Optional, Tuple
 
-from fastapi import FastAPI, UploadFile, File, Form, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi import Body
 
+import httpx
+import orjson
+from rapidfuzz import fuzz, process
 from dotenv import load_dotenv
-from utils import extract_text_from_file
+from utils import LRUCache, extract_text_from_bytes
+from logging_setup import start_queue_logging
+# Groq client, budgets and reply parsing (reads its own settings from .env)
+from groq_client import (
+    GROQ_CLIENT, GROQ_MAX_TOKENS, GROQ_MAX_INPUT_TOKENS, GRADE_TEMPERATURE, ItemCheck,
+    call_groq, estimate_call_tokens, extract_json_array, limiter, truncate_text, warm_encoding,
+    MAX_CHARS_PER_TOKEN, clean_model_output,
+)
 
 # --- Socket.IO (minimal) ---
 import socketio
 
-# Load .env early (before creating any clients)
+# Supabase/Redis/CORS settings below come from .env too (groq_client loads it for its own).
 load_dotenv()
 
-# ---- Groq ----
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-# You set this default; fallbacks are below.
-GROQ_MODEL   = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
-GROQ_MAX_TOKENS = int(os.getenv("GROQ_MAX_TOKENS", "6000"))
-
-# Soft local budgets (so we can proactively switch)
-GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))        # requests per minute
-GROQ_RPD = int(os.getenv("GROQ_RPD", "1000"))      # requests per day
-GROQ_TPM = int(os.getenv("GROQ_TPM", "12000"))     # tokens per minute (in+out)
-GROQ_TPD = int(os.getenv("GROQ_TPD", "100000"))    # tokens per day (in+out)
-
-if not GROQ_API_KEY:
-    raise ValueError("GROQ_API_KEY is missing. Check backend/.env.")
-
-FALLBACK_MODELS = [
-    "llama-3.3-70b-versatile",                         # strong generalist
-    "meta-llama/llama-4-scout-17b-16e-instruct",       # instruction-following
-    "gemma2-9b-it",                                    # reliable JSON
-    "llama-3.1-8b-instant",                            # fast/cheap
-    "deepseek-r1-distill-llama-70b",                   # powerful; emits <think>
-    # "openai/gpt-oss-20b",                            # optional extra backup
-]
-
 # ---- Supabase (server) ----
 SUPABASE_URL = (os.getenv("SUPABASE_URL") or "").rstrip("/")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
@@ -55,47 +42,238 @@ SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
     raise ValueError("Supabase env missing: set SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY in backend/.env")
 
-from supabase import create_client, Client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+from supabase import create_client, Client, ClientOptions
+# One pooled, keep-alive client for every PostgREST call, instead of the library default.
+SUPABASE_HTTP = httpx.Client(
+    timeout=10,
+    limits=httpx.Limits(max_connections=30, max_keepalive_connections=20),
+)
+supabase: Client = create_client(
+    SUPABASE_URL,
+    SUPABASE_SERVICE_ROLE_KEY,
+    options=ClientOptions(postgrest_client_timeout=10, httpx_client=SUPABASE_HTTP),
+)
+
+# Optional direct Postgres access (e.g. Supabase's transaction pooler on :6543). When set,
+# hot-path reads skip the PostgREST HTTP hop and the worker thread the sync client needs.
+DATABASE_URL = os.getenv("DATABASE_URL")
+db_pool = None  # asyncpg.Pool, created on startup
+
+async def _fetch_question(qid: str) -> Dict[str, Any]:
+    if db_pool is not None:
+        rec = await db_pool.fetchrow(
+            "select id, type, text, correct_answer from quiz_questions where id = $1", qid
+        )
+        return dict(rec) if rec else {}
+    query = supabase.table("quiz_questions") \
+        .select("id,type,text,correct_answer") \
+        .eq("id", qid).maybe_single()
+    # supabase-py is synchronous; keep it off the event loop
+    res = await asyncio.to_thread(query.execute)
+    row = (res.data if hasattr(res, "data") else res.get("data"))
+    return row or {}
+
+async def _fetch_questions(qids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Batch form of _fetch_question: one round trip, rows keyed by id."""
+    if db_pool is not None:
+        recs = await db_pool.fetch(
+            "select id, type, text, correct_answer from quiz_questions where id = any($1::uuid[])", qids
+        )
+        return {str(r["id"]): dict(r) for r in recs}
+    query = supabase.table("quiz_questions") \
+        .select("id,type,text,correct_answer") \
+        .in_("id", qids)
+    res = await asyncio.to_thread(query.execute)
+    rows = (res.data if hasattr(res, "data") else res.get("data")) or []
+    return {str(r["id"]): r for r in rows}
 
 def db_health():
-    return supabase.table("pg_stat_activity").select("datname").limit(1).execute()
+    # Cheapest possible round-trip: one id from a small app table (system views are slow).
+    return supabase.table("quiz_questions").select("id").limit(1).execute()
 
 # ---------- App / CORS ----------
-app = FastAPI()
+# Comma-separated frontend origins, e.g. "http://localhost:5173,http://192.168.1.20:5173".
+# Defaults to any origin, since classroom setups reach the backend over a LAN address.
+CORS_ORIGINS = [o.strip().rstrip("/") for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
+
+app = FastAPI(default_response_class=ORJSONResponse)
+# Preflights (including the multipart POST to /generate-quiz) are answered by this middleware.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=False,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
 )
+# Quiz arrays are 10-30 KB of repetitive JSON; small replies (grading verdicts) go out as-is.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
-# Request logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+# Request logging goes through a queue: the stderr write happens on the listener thread.
+_log_listener = start_queue_logging()
 log = logging.getLogger("learnverse-backend")
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    try:
-        response = await call_next(request)
-        log.info("%s %s -> %s", request.method, request.url.path, response.status_code)
-        return response
-    except Exception as e:
-        log.exception("ERROR %s %s: %s", request.method, request.url.path, e)
-        raise
+@app.on_event("startup")
+async def _open_db_pool():
+    global db_pool
+    if DATABASE_URL:
+        import asyncpg
+        # The transaction pooler can't keep prepared statements across transactions
+        db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=5, max_size=20, statement_cache_size=0)
+
+@app.on_event("startup")
+async def _warm_tokenizer():
+    await warm_encoding()
+
+@app.on_event("shutdown")
+async def _close_db():
+    SUPABASE_HTTP.close()
+    if db_pool is not None:
+        await db_pool.close()
+
+@app.on_event("shutdown")
+async def _close_groq_client():
+    await GROQ_CLIENT.aclose()
+
+@app.on_event("shutdown")
+def _stop_log_listener():
+    _log_listener.stop()  # flushes anything still queued
+
+# Plain ASGI middleware (BaseHTTPMiddleware adds a task + stream per request). Preflights and
+# health probes are not logged; Socket.IO traffic never reaches the FastAPI app at all.
+_UNLOGGED_PATHS = ("/health",)
+
+class _RequestLogMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] == "OPTIONS"
+            or scope["path"] in _UNLOGGED_PATHS
+            or not log.isEnabledFor(logging.INFO)
+        ):
+            return await self.app(scope, receive, send)
+
+        status = 500
+        async def send_and_record(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
 
-# Explicit OPTIONS handler
-@app.options("/generate-quiz")
-async def options_generate_quiz():
-    return JSONResponse(status_code=204, content=None)
+        try:
+            await self.app(scope, receive, send_and_record)
+        except Exception as e:
+            log.exception("ERROR %s %s: %s", scope["method"], scope["path"], e)
+            raise
+        log.info("%s %s -> %s", scope["method"], scope["path"], status)
+
+app.add_middleware(_RequestLogMiddleware)
 
 # ---------- Socket.IO ----------
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
-socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
+# Set REDIS_URL to run several workers/instances: broadcasts then go through Redis pub/sub and
+# room membership lives in Redis hashes. Without it everything stays in this process.
+REDIS_URL = os.getenv("REDIS_URL")
+
+class LocalParticipants:
+    """
+    room_code -> {sid: {"name", "student_id"}}; join/leave are O(1) dict operations.
+    Display names are cached per room and dropped whenever membership changes.
+    A room only exists while it has members, so nothing needs garbage-collecting.
+    """
+    def __init__(self):
+        self.rooms: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._names: Dict[str, List[str]] = {}
+
+    async def open(self, room_code: str):
+        pass  # created by the first join; an opened-but-empty room reads as no participants
+
+    async def add(self, room_code: str, sid: str, info: Dict[str, Any]) -> bool:
+        participants = self.rooms.setdefault(room_code, {})
+        if sid in participants:
+            return False
+        participants[sid] = info
+        self._names.pop(room_code, None)
+        return True
+
+    async def remove(self, room_code: str, sid: str) -> bool:
+        participants = self.rooms.get(room_code)
+        if participants is None or participants.pop(sid, None) is None:
+            return False
+        if not participants:
+            del self.rooms[room_code]
+        self._names.pop(room_code, None)
+        return True
+
+    async def names(self, room_code: str) -> List[str]:
+        names = self._names.get(room_code)
+        if names is None:
+            members = self.rooms.get(room_code)
+            if not members:
+                return []  # don't cache entries for rooms that don't exist
+            names = [p["name"] for p in members.values()]
+            self._names[room_code] = names
+        return names
+
+class RedisParticipants:
+    """
+    Same interface as LocalParticipants, backed by one Redis hash per room (sid -> JSON).
+    """
+    TTL_S = 12 * 3600  # stale rooms expire on their own
+
+    def __init__(self, url: str):
+        import redis.asyncio as aioredis
+        self.redis = aioredis.from_url(url)
 
-room_participants: Dict[str, List[Dict[str, Any]]] = {}
+    @staticmethod
+    def _key(room_code: str) -> str:
+        return f"room:{room_code}:participants"
 
+    async def open(self, room_code: str):
+        pass  # a Redis hash exists once it has a member
+
+    async def add(self, room_code: str, sid: str, info: Dict[str, Any]) -> bool:
+        key = self._key(room_code)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            added, _ = await pipe.hsetnx(key, sid, orjson.dumps(info)).expire(key, self.TTL_S).execute()
+        return bool(added)
+
+    async def remove(self, room_code: str, sid: str) -> bool:
+        return bool(await self.redis.hdel(self._key(room_code), sid))
+
+    async def names(self, room_code: str) -> List[str]:
+        return [orjson.loads(v)["name"] for v in await self.redis.hvals(self._key(room_code))]
+
+class _OrjsonForSocketIO:
+    """json-module stand-in for python-socketio/engineio packet (de)serialization."""
+    @staticmethod
+    def dumps(obj, **kwargs) -> str:  # stdlib kwargs such as separators= are implied
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+_SIO_CORS = "*" if "*" in CORS_ORIGINS else CORS_ORIGINS
+
+if REDIS_URL:
+    sio = socketio.AsyncServer(
+        async_mode="asgi",
+        client_manager=socketio.AsyncRedisManager(REDIS_URL),
+        cors_allowed_origins=_SIO_CORS,
+        json=_OrjsonForSocketIO,
+    )
+    participants = RedisParticipants(REDIS_URL)
+else:
+    sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins=_SIO_CORS, json=_OrjsonForSocketIO)
+    participants = LocalParticipants()
+socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
+
+# Membership changes go out as deltas ("server:participants-added"/"-removed", just the
+# changed names) so each join/leave costs O(1) payload instead of rebroadcasting the full list;
+# the full "server:participants" snapshot is only sent to the client that just joined
+# (hosts get theirs in "server:quiz-opened").
 @sio.event
 async def student_join(sid, data):
     data = data or {}
@@ -106,13 +284,12 @@ async def student_join(sid, data):
         return
     await sio.save_session(sid, {"role": "student", "room": room_code, "student_id": student_id, "name": name})
     await sio.enter_room(sid, room_code)
-    participants = room_participants.setdefault(room_code, [])
-    if not any(p["sid"] == sid for p in participants):
-        participants.append({"sid": sid, "name": name, "student_id": student_id})
+    if await participants.add(room_code, sid, {"name": name, "student_id": student_id}):
+        await sio.emit("server:participants-added", {"room": room_code, "added": [name]}, room=room_code, skip_sid=sid)
     await sio.emit(
-        "server:student-joined",
-        {"name": name, "student_id": student_id, "participants": [p["name"] for p in participants]},
-        room=room_code,
+        "server:participants",
+        {"room": room_code, "participants": await participants.names(room_code)},
+        to=sid,
     )
 
 @sio.event
@@ -125,14 +302,14 @@ async def host_open_quiz(sid, data):
         return
     await sio.save_session(sid, {"role": "host", "room": room_code, "quiz_id": quiz_id, "title": title})
     await sio.enter_room(sid, room_code)
-    room_participants.setdefault(room_code, [])
+    await participants.open(room_code)
     await sio.emit(
         "server:quiz-opened",
         {
             "room": room_code,
             "quiz_id": quiz_id,
             "title": title,
-            "participants": [p["name"] for p in room_participants[room_code]],
+            "participants": await participants.names(room_code),
         },
         to=sid,
     )
@@ -141,7 +318,8 @@ async def host_open_quiz(sid, data):
 async def host_start(sid, data):
     room_code = (data or {}).get("room")
     if room_code:
-        await sio.emit("server:quiz-start", data, room=room_code)
+        # The host navigates on its own after emitting; only students need the broadcast.
+        await sio.emit("server:quiz-start", data, room=room_code, skip_sid=sid)
 
 @sio.event
 async def host_end(sid, data):
@@ -167,48 +345,23 @@ async def disconnect(sid):
     if not session:
         return
     room_code = session.get("room")
-    role = session.get("role")
-    name = session.get("name")
-    if room_code and room_code in room_participants:
-        room_participants[room_code] = [p for p in room_participants[room_code] if p["sid"] != sid]
+    if room_code and await participants.remove(room_code, sid):
         await sio.emit(
-            "server:client-left",
-            {"sid": sid, "role": role, "name": name, "participants": [p["name"] for p in room_participants[room_code]]},
-            room=room_code,
+            "server:participants-removed", {"room": room_code, "removed": [session.get("name")]}, room=room_code
         )
 
 # ---------- Quiz generation helpers ----------
-def generate_prompt(
-    text: str, 
-    mcq_count: int, 
-    sa_count: int, 
-    tf_count: int, 
-    idf_count: int, 
-    ess_count: int,
-    difficulty: str
-) -> str:
-    total = mcq_count + sa_count + tf_count + idf_count + ess_count
-    
-    # Difficulty instructions
-    diff_instructions = {
-        "Easy": "Questions should be straightforward, testing basic recall and understanding. Use simple language.",
-        "Intermediate": "Questions should require moderate understanding and application of concepts.",
-        "Difficult": "Questions should be challenging, requiring deep analysis, critical thinking, and synthesis of multiple concepts."
-    }
-    diff_guide = diff_instructions.get(difficulty, diff_instructions["Intermediate"])
-    
-    return f"""
-You are generating a quiz STRICTLY from the supplied learning material.
+_DIFFICULTY_GUIDES = {
+    "Easy": "Questions should be straightforward, testing basic recall and understanding. Use simple language.",
+    "Intermediate": "Questions should require moderate understanding and application of concepts.",
+    "Difficult": "Questions should be challenging, requiring deep analysis, critical thinking, and synthesis of multiple concepts."
+}
 
-DIFFICULTY LEVEL: {difficulty}
-{diff_guide}
+# Static instructions: byte-identical on every request, sent as the system message so the
+# provider can reuse its cached prefix. Everything request-specific goes in the user message.
+QUIZ_SYSTEM_PROMPT = """You are generating a quiz STRICTLY from the supplied learning material.
 
-Return ONLY a JSON ARRAY (no code fences, no keys outside the array, no comments), with EXACTLY {total} items:
-- First, {mcq_count} objects with "type":"mcq"
-- Then, {sa_count} objects with "type":"short_answer"
-- Then, {tf_count} objects with "type":"true_false"
-- Then, {idf_count} objects with "type":"identification"
-- Then, {ess_count} objects with "type":"essay"
+Return ONLY a JSON ARRAY (no code fences, no keys outside the array, no comments), with EXACTLY the requested number of items, grouped by type in the requested order.
 
 Schema per item:
 - type: "mcq" | "short_answer" | "true_false" | "identification" | "essay"
@@ -223,290 +376,78 @@ Hard rules:
 - Use ONLY information present in the provided material.
 - Do NOT include any text before or after the JSON array.
 - Do NOT include code fences like ``` or any <think> tags.
-- Ensure EXACT counts. If you produce more than {total}, only the first {total} will be used; if fewer, your response will be rejected.
-- Adjust question complexity according to the difficulty level: {difficulty}.
+- Ensure EXACT counts. If you produce more than requested, only the first ones will be used; if fewer, your response will be rejected.
+- Adjust question complexity according to the requested difficulty level."""
+
+# Per-request part: only the counts are formatted; the learning material is spliced in
+# afterwards (it may contain braces, so it never goes through format).
+_PROMPT_HEADER = """DIFFICULTY LEVEL: {difficulty}
+{diff_guide}
+
+Return EXACTLY {total} items:
+- First, {mcq_count} objects with "type":"mcq"
+- Then, {sa_count} objects with "type":"short_answer"
+- Then, {tf_count} objects with "type":"true_false"
+- Then, {idf_count} objects with "type":"identification"
+- Then, {ess_count} objects with "type":"essay"
 
 Learning Material:
-\"\"\"{text}\"\"\"
-""".strip()
-
-def truncate_text(text: str, max_chars: int = 12000) -> str:
-    return text[:max_chars] if len(text) > max_chars else text
-
-# ---- Groq helpers ----
-GROQ_ENDPOINT = "https://api.groq.com/openai/v1/chat/completions"
-GROQ_TIMEOUT_S = 75
-
-def _post_to_groq(model: str, prompt: str, max_tokens: int) -> requests.Response:
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    data = {
-        "model": model,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.1,
-        "top_p": 1.0,
-        "max_tokens": max_tokens,
-        "stop": ["```", "<think>", "</think>"],
-    }
-    return requests.post(GROQ_ENDPOINT, headers=headers, json=data, timeout=GROQ_TIMEOUT_S)
-
-# ---------- Simple in-memory rate limiter + model cooldowns ----------
-class RateLimiter:
-    """
-    Global soft budgets to avoid hammering the API.
-    """
-    def __init__(self, rpm:int, rpd:int, tpm:int, tpd:int):
-        self.rpm_limit = rpm
-        self.rpd_limit = rpd
-        self.tpm_limit = tpm
-        self.tpd_limit = tpd
-        self._minute_epoch = self._now_minute()
-        self._day_epoch = self._now_day()
-        self.rpm_used = 0
-        self.tpm_used = 0
-        self.rpd_used = 0
-        self.tpd_used = 0
-        # Model cooldowns: model -> unix timestamp
-        self.model_cooldown_until: Dict[str, float] = {}
-
-    def _now_minute(self) -> int:
-        return int(time.time() // 60)
-
-    def _now_day(self) -> int:
-        return int(time.time() // 86400)
-
-    def _maybe_roll_windows(self):
-        cur_min = self._now_minute()
-        if cur_min != self._minute_epoch:
-            self._minute_epoch = cur_min
-            self.rpm_used = 0
-            self.tpm_used = 0
-        cur_day = self._now_day()
-        if cur_day != self._day_epoch:
-            self._day_epoch = cur_day
-            self.rpd_used = 0
-            self.tpd_used = 0
-
-    def is_model_on_cooldown(self, model: str) -> bool:
-        until = self.model_cooldown_until.get(model, 0)
-        return until and time.time() < until
-
-    def set_cooldown(self, model: str, seconds: float):
-        self.model_cooldown_until[model] = max(self.model_cooldown_until.get(model, 0), time.time() + seconds)
-
-    def can_afford(self, req_tokens_est:int = 0) -> Tuple[bool, str]:
-        self._maybe_roll_windows()
-        if self.rpm_used + 1 > self.rpm_limit:
-            return False, "rpm_exhausted"
-        if self.rpd_used + 1 > self.rpd_limit:
-            return False, "rpd_exhausted"
-        if self.tpm_used + req_tokens_est > self.tpm_limit:
-            return False, "tpm_exhausted"
-        if self.tpd_used + req_tokens_est > self.tpd_limit:
-            return False, "tpd_exhausted"
-        return True, ""
-
-    def reserve(self, req_tokens_est:int = 0):
-        self._maybe_roll_windows()
-        self.rpm_used += 1
-        self.rpd_used += 1
-        self.tpm_used += req_tokens_est
-        self.tpd_used += req_tokens_est
-
-    def adjust_after_response(self, est_reserved:int, actual_total_tokens:int):
-        """
-        Adjust token counters to the actual usage; allow negative delta.
-        """
-        self._maybe_roll_windows()
-        delta = actual_total_tokens - est_reserved
-        # allow reducing the reservation if actual < estimate
-        self.tpm_used = max(0, self.tpm_used + delta)
-        self.tpd_used = max(0, self.tpd_used + delta)
-
-limiter = RateLimiter(GROQ_RPM, GROQ_RPD, GROQ_TPM, GROQ_TPD)
-
-def _estimate_tokens_for_request(prompt:str, out_tokens_cap:int) -> int:
-    # ~4 chars/token; be less pessimistic (50% of cap) to reduce over-reserving
-    in_tokens = max(1, len(prompt) // 4)
-    out_tokens = max(1, int(out_tokens_cap * 0.5))
-    return in_tokens + out_tokens
-
-def _parse_usage_total_tokens(resp_json: Dict[str, Any]) -> Optional[int]:
-    try:
-        usage = resp_json.get("usage") or {}
-        total = usage.get("total_tokens")
-        if isinstance(total, int) and total > 0:
-            return total
-    except Exception:
-        pass
-    return None
+\"\"\""""
+_PROMPT_FOOTER = '"""'
+
+# Everything before the material depends only on (counts, difficulty): format each combination
+# once. The form defaults are warmed at import; top-ups' smaller counts fill in as they occur.
+@functools.lru_cache(maxsize=64)
+def _format_prompt_header(mcq_count: int, sa_count: int, tf_count: int, idf_count: int, ess_count: int, difficulty: str) -> str:
+    return _PROMPT_HEADER.format(
+        difficulty=difficulty,
+        diff_guide=_DIFFICULTY_GUIDES.get(difficulty, _DIFFICULTY_GUIDES["Intermediate"]),
+        total=mcq_count + sa_count + tf_count + idf_count + ess_count,
+        mcq_count=mcq_count,
+        sa_count=sa_count,
+        tf_count=tf_count,
+        idf_count=idf_count,
+        ess_count=ess_count,
+    )
 
-def _model_list_preference() -> List[str]:
-    ordered, seen = [], set()
-    for m in [GROQ_MODEL] + FALLBACK_MODELS:
-        if m not in seen:
-            ordered.append(m); seen.add(m)
-    return ordered
+_DEFAULT_COUNTS = (3, 3, 4, 0, 0)
+for _difficulty in _DIFFICULTY_GUIDES:
+    _format_prompt_header(*_DEFAULT_COUNTS, _difficulty)
 
-def choose_model(prompt: str, out_tokens_cap: int) -> Optional[str]:
-    """
-    Pick the first model we can afford and that's not on cooldown.
-    """
-    est = _estimate_tokens_for_request(prompt, out_tokens_cap)
-    for model in _model_list_preference():
-        if limiter.is_model_on_cooldown(model):
-            log.warning("Model %s is on cooldown; skipping.", model)
-            continue
-        ok, reason = limiter.can_afford(est)
-        if ok:
-            return model
-        log.warning("Local budget near/over limit (%s); trying fallback model.", reason)
-    return None  # none affordable right now
-
-# Provider error helpers
-_QUOTA_HINTS = ("quota", "daily", "exceed", "exceeded", "limit", "insufficient", "tpm", "rpm", "tpd", "rpd", "rate")
-def _looks_like_quota_or_rate(err_json: Dict[str, Any]) -> Tuple[bool, str]:
-    msg = ""
-    try:
-        e = err_json.get("error") or {}
-        msg = (e.get("message") or "") + " " + (e.get("code") or "")
-        msg = msg.lower()
-    except Exception:
-        pass
-    hit = any(k in msg for k in _QUOTA_HINTS)
-    return hit, msg
-
-def call_groq(prompt: str, max_tokens_override: Optional[int] = None) -> str:
+def generate_prompt(
+    text: str, 
+    mcq_count: int, 
+    sa_count: int, 
+    tf_count: int, 
+    idf_count: int, 
+    ess_count: int,
+    difficulty: str
+) -> Tuple[str, str]:
     """
-    Budget-aware call with optional small max_tokens for top-up.
-    - Releases unused reservations (fixes false TPM exhaustion).
-    - Skips models on cooldown and sets cooldowns on provider quota/rate errors.
+    Returns (system, user) messages for the quiz request.
     """
-    out_cap = max_tokens_override if max_tokens_override is not None else GROQ_MAX_TOKENS
-    estimate = _estimate_tokens_for_request(prompt, out_cap)
-
-    models_to_try, tried = [], set()
-    first = choose_model(prompt, out_cap)
-    if first:
-        models_to_try.append(first); tried.add(first)
-    for m in _model_list_preference():
-        if m not in tried:
-            models_to_try.append(m); tried.add(m)
-
-    if not models_to_try:
-        # Nothing affordable now; surface a clear error
-        raise RuntimeError("Local budgets exhausted; please retry shortly.")
-
-    def parse_err(resp):
-        try: return resp.json()
-        except Exception: return {"error": {"message": resp.text, "code": str(resp.status_code)}}
-
-    backoffs = [0.3, 0.6]
-    last_error = None
-
-    for model in models_to_try:
-        if limiter.is_model_on_cooldown(model):
-            log.warning("Model %s still on cooldown; skipping.", model)
-            continue
-
-        can, reason = limiter.can_afford(estimate)
-        if not can:
-            log.warning("Skipping %s due to local budgets: %s", model, reason)
-            continue
-
-        limiter.reserve(estimate)
-        log.info("Calling Groq model=%s (reserved est=%d tokens)", model, estimate)
-        r = _post_to_groq(model, prompt, max_tokens=out_cap)
-        if r.status_code == 200:
-            j = r.json()
-            used = _parse_usage_total_tokens(j) or estimate
-            limiter.adjust_after_response(estimate, used)
-            out = j["choices"][0]["message"]["content"]
-            log.info("Groq OK model=%s tokens_used=%s", model, used)
-            return out
-
-        # Not 200 -> inspect
-        err = parse_err(r)
-        last_error = (r.status_code, err)
-        log.error("[GROQ ERROR] model=%s %s %s", model, r.status_code, err)
-
-        # Always release reservation with a small usage (assume request tokens only) to avoid overhang
-        limiter.adjust_after_response(estimate, actual_total_tokens=max(1, len(prompt)//4))
-
-        code_lower = ""
-        try:
-            code_lower = str(err.get("error", {}).get("code", "")).lower()
-        except Exception:
-            pass
-        msg_hit, msg_text = _looks_like_quota_or_rate(err)
-
-        # If the provider hints quota/rate, cooldown this model so next attempts try fallbacks.
-        if r.status_code in (429, 403) or msg_hit or any(k in code_lower for k in _QUOTA_HINTS):
-            # TPM/RPM -> short cooldown; Daily quota -> longer cooldown
-            if any(k in msg_text for k in ("tpm", "rpm", "rate")):
-                limiter.set_cooldown(model, seconds=60)        # 1 minute
-                log.warning("Cooldown set: %s for 60s due to rate/TPM.", model)
-            elif any(k in msg_text for k in ("daily", "tpd", "rpd", "quota", "insufficient", "exceed", "exceeded", "limit")):
-                limiter.set_cooldown(model, seconds=6*3600)    # 6 hours
-                log.warning("Cooldown set: %s for 6h due to daily/quota.", model)
-            # Try next model immediately
-            continue
-
-        # Transient 5xx -> quick retries with same model, then next
-        if r.status_code in (500, 502, 503):
-            for b in backoffs:
-                log.warning("Transient %s; retrying model=%s after %.1fs", r.status_code, model, b)
-                time.sleep(b)
-                r2 = _post_to_groq(model, prompt, max_tokens=out_cap)
-                if r2.status_code == 200:
-                    j2 = r2.json()
-                    used2 = _parse_usage_total_tokens(j2) or estimate
-                    limiter.adjust_after_response(estimate, used2)
-                    out2 = j2["choices"][0]["message"]["content"]
-                    log.info("Groq OK (retry) model=%s tokens_used=%s", model, used2)
-                    return out2
-                else:
-                    err2 = parse_err(r2)
-                    log.error("[GROQ RETRY ERROR] model=%s %s %s", model, r2.status_code, err2)
-            log.warning("Switching model after transient issue.")
-            continue
-
-        # Other client errors: try next model
-        log.warning("Unhandled error for model=%s; trying next model.", model)
-
-    status, err = last_error if last_error else (500, {"error": "Unknown Groq failure"})
-    raise RuntimeError(f"Groq {status}: {err}")
-
-# -------- Output sanitization & parsing --------
-_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL | re.IGNORECASE)
-_FENCE_RE = re.compile(r"```(?:json)?(.*?)```", re.DOTALL | re.IGNORECASE)
-
-def _clean_model_output(text: str) -> str:
-    text = _THINK_RE.sub("", text).strip()
-    m = _FENCE_RE.search(text)
-    if m:
-        text = m.group(1).strip()
-    return text.replace("\ufeff", "").strip("` \n\r\t")
-
-def extract_json_array(text: str):
-    text = _clean_model_output(text)
-    start = text.find("["); end = text.rfind("]")
-    if start == -1 or end == -1 or end <= start:
-        raise ValueError("No valid JSON array found in output.")
-    json_str = text[start : end + 1]
-    try:
-        return json.loads(json_str)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Failed to parse JSON array: {e}")
+    header = _format_prompt_header(mcq_count, sa_count, tf_count, idf_count, ess_count, difficulty)
+    return QUIZ_SYSTEM_PROMPT, "".join((header, text, _PROMPT_FOOTER))
 
 # -------- Normalization, repair & validation --------
-def _ascii_quotes(s: str) -> str:
-    return s.replace("“", '"').replace("”", '"').replace("‘", "'").replace("’", "'")
+_WS_RE = re.compile(r"\s+")
+_QUOTE_TABLE = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]")
+# ASCII counterpart of _NON_ALNUM_RE as a str.translate deletion table (a plain C loop)
+_NON_ALNUM_ASCII_TBL = str.maketrans("", "", "".join(
+    chr(i) for i in range(128) if not ("a" <= chr(i) <= "z" or "0" <= chr(i) <= "9")
+))
+
+def _alnum_key(s: str) -> str:
+    """Lowercase and keep only a-z0-9 (identification answers compare on this)."""
+    s = s.lower()
+    if s.isascii():
+        return s.translate(_NON_ALNUM_ASCII_TBL)
+    return _NON_ALNUM_RE.sub("", s)
 
 def _norm_text(s: str) -> str:
-    return re.sub(r"\s+", " ", _ascii_quotes(s or "")).strip()
+    return _WS_RE.sub(" ", s.translate(_QUOTE_TABLE) if s else "").strip()
 
 def _normalize_item(item: Dict[str, Any]) -> Dict[str, Any]:
     t = item.get("type")
@@ -528,20 +469,8 @@ def _normalize_item(item: Dict[str, Any]) -> Dict[str, Any]:
             elif s == "false": item["answer"] = False
     return item
 
-def _normalize_items(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    out = []
-    for it in items:
-        if isinstance(it, dict):
-            out.append(_normalize_item(it))
-    return out
-
-def _answers_match(ans: str, choices: List[str]) -> bool:
-    a = _norm_text(ans)
-    for c in choices:
-        if _norm_text(c) == a:
-            return True
-    return False
-
+# Repair and validation run after _normalize_item, so MCQ string choices/answers are already
+# in _norm_text form and are compared directly instead of being re-normalized per comparison.
 def _repair_mcq(item: Dict[str, Any]) -> Dict[str, Any]:
     if item.get("type") != "mcq": return item
     choices = item.get("choices")
@@ -550,39 +479,21 @@ def _repair_mcq(item: Dict[str, Any]) -> Dict[str, Any]:
         return item
     # Trim >4 choices preserving the correct answer
     if len(choices) > 4:
-        norm_ans = _norm_text(ans) if isinstance(ans, str) else ans
-        new = []
-        for c in choices:
-            if isinstance(c, str) and _norm_text(c) == norm_ans:
-                new.append(c); break
+        new = [ans] if isinstance(ans, str) and ans in choices else []
         for c in choices:
             if len(new) >= 4: break
             if c not in new and isinstance(c, str):
                 new.append(c)
         item["choices"] = new[:4]
     # Fuzzy-map answer to closest choice if not exact
-    if isinstance(item.get("answer"), str) and isinstance(item.get("choices"), list):
-        if not _answers_match(item["answer"], item["choices"]):
-            norm_ans = _norm_text(item["answer"])
-            norm_choices = [_norm_text(c) for c in item["choices"] if isinstance(c, str)]
-            if norm_choices:
-                match = difflib.get_close_matches(norm_ans, norm_choices, n=1, cutoff=0.6)
-                if match:
-                    for c in item["choices"]:
-                        if isinstance(c, str) and _norm_text(c) == match[0]:
-                            item["answer"] = c
-                            break
+    if isinstance(ans, str):
+        str_choices = [c for c in item["choices"] if isinstance(c, str)]
+        if str_choices and ans not in str_choices:
+            match = process.extractOne(ans, str_choices, scorer=fuzz.ratio, score_cutoff=60)
+            if match:
+                item["answer"] = match[0]
     return item
 
-def _repair_items(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    fixed = []
-    for it in items:
-        if isinstance(it, dict) and it.get("type") == "mcq":
-            fixed.append(_repair_mcq(it))
-        else:
-            fixed.append(it)
-    return fixed
-
 def _is_valid_mcq(item: Dict[str, Any]) -> bool:
     if item.get("type") != "mcq":
         return False
@@ -591,11 +502,9 @@ def _is_valid_mcq(item: Dict[str, Any]) -> bool:
     ans = item.get("answer")
     if not isinstance(q, str) or not isinstance(choices, list) or len(choices) != 4 or not isinstance(ans, str):
         return False
-    if any(not isinstance(c, str) or len(_norm_text(c)) < 3 for c in choices):
+    if any(not isinstance(c, str) or len(c) < 3 for c in choices):
         return False
-    if not _answers_match(ans, choices):
-        return False
-    return True
+    return ans in choices
 
 def _is_valid_short(item: Dict[str, Any]) -> bool:
     return (
@@ -628,26 +537,37 @@ def _is_valid_essay(item: Dict[str, Any]) -> bool:
         and len(_norm_text(item.get("answer"))) > 0
     )
 
+# type -> (index of its group in _filter_and_partition's result, validator)
+_ITEM_KINDS = {
+    "mcq": (0, _is_valid_mcq),
+    "short_answer": (1, _is_valid_short),
+    "true_false": (2, _is_valid_tf),
+    "identification": (3, _is_valid_identification),
+    "essay": (4, _is_valid_essay),
+}
+
 def _filter_and_partition(items: List[Dict[str, Any]]):
-    items = _normalize_items(items)
-    items = _repair_items(items)
-    mcq, sa, tf, idf, ess = [], [], [], [], []
+    """
+    One pass over the parsed array: each item is normalized, repaired (MCQ), validated and
+    dropped into its type's group. Returns (mcq, sa, tf, idf, ess).
+    """
+    groups: Tuple[List[Dict[str, Any]], ...] = ([], [], [], [], [])
     for it in items:
+        if not isinstance(it, dict):
+            continue
         try:
-            t = it.get("type")
-            if t == "mcq" and _is_valid_mcq(it):
-                mcq.append(it)
-            elif t == "short_answer" and _is_valid_short(it):
-                sa.append(it)
-            elif t == "true_false" and _is_valid_tf(it):
-                tf.append(it)
-            elif t == "identification" and _is_valid_identification(it):
-                idf.append(it)
-            elif t == "essay" and _is_valid_essay(it):
-                ess.append(it)
+            it = _normalize_item(it)
+            kind = _ITEM_KINDS.get(it.get("type"))
+            if kind is None:
+                continue
+            k, is_valid = kind
+            if k == 0:
+                it = _repair_mcq(it)
+            if is_valid(it):
+                groups[k].append(it)
         except Exception:
             continue
-    return mcq, sa, tf, idf, ess
+    return groups
 
 def _merge_trim_to_counts(
     mcq: List[Dict[str, Any]],
@@ -667,10 +587,53 @@ def _counts_satisfied(mcq, sa, tf, idf, ess, need_mcq, need_sa, need_tf, need_id
     return (len(mcq) >= need_mcq and len(sa) >= need_sa and len(tf) >= need_tf 
             and len(idf) >= need_idf and len(ess) >= need_ess)
 
+def _enough_items(need_mcq: int, need_sa: int, need_tf: int, need_idf: int, need_ess: int) -> Callable[[], ItemCheck]:
+    """
+    ItemCheck factory for call_groq: validates each streamed item as it completes and stops
+    the stream once every requested type has enough valid items (extras are never generated).
+    """
+    need = (need_mcq, need_sa, need_tf, need_idf, need_ess)
+    def make() -> ItemCheck:
+        have = [0] * len(need)
+        def check(item_json: str) -> bool:
+            try:
+                item = orjson.loads(item_json)
+            except orjson.JSONDecodeError:
+                return False
+            for k, group in enumerate(_filter_and_partition([item])):
+                have[k] += len(group)
+            return all(h >= n for h, n in zip(have, need))
+        return check
+    return make
+
+def _has_enough_items(need_mcq: int, need_sa: int, need_tf: int, need_idf: int, need_ess: int) -> Callable[[str], bool]:
+    """
+    cache_if for call_groq: only a reply that parses and already holds every requested count is
+    cached. A short or malformed one is not, so the retry that follows gets a fresh sample.
+    """
+    def ok(raw: str) -> bool:
+        try:
+            arr = extract_json_array(raw)
+        except ValueError:
+            return False
+        return isinstance(arr, list) and _counts_satisfied(
+            *_filter_and_partition(arr), need_mcq, need_sa, need_tf, need_idf, need_ess
+        )
+    return ok
+
 def _estimate_topup_tokens(missing_mcq: int, missing_sa: int, missing_tf: int, missing_idf: int, missing_ess: int) -> int:
     return max(300, missing_mcq * 220 + missing_sa * 120 + missing_tf * 40 + missing_idf * 100 + missing_ess * 180)
 
-def _top_up_generation(
+def _top_up_request(
+    base_text: str,
+    missing_mcq: int, missing_sa: int, missing_tf: int, missing_idf: int, missing_ess: int,
+    difficulty: str
+) -> Tuple[str, str, int]:
+    """(system, prompt, max_tokens) for a top-up asking for exactly the missing counts."""
+    system, prompt = generate_prompt(base_text, missing_mcq, missing_sa, missing_tf, missing_idf, missing_ess, difficulty)
+    return system, prompt, min(1200, _estimate_topup_tokens(missing_mcq, missing_sa, missing_tf, missing_idf, missing_ess))
+
+async def _top_up_generation(
     base_text: str,
     have_mcq: int, have_sa: int, have_tf: int, have_idf: int, have_ess: int,
     need_mcq: int, need_sa: int, need_tf: int, need_idf: int, need_ess: int,
@@ -685,15 +648,20 @@ def _top_up_generation(
     if (missing_mcq + missing_sa + missing_tf + missing_idf + missing_ess) == 0:
         return []
     
-    prompt2 = generate_prompt(base_text, missing_mcq, missing_sa, missing_tf, missing_idf, missing_ess, difficulty)
-    small_cap = min(1200, _estimate_topup_tokens(missing_mcq, missing_sa, missing_tf, missing_idf, missing_ess))
-    raw2 = call_groq(prompt2, max_tokens_override=small_cap)
+    system2, prompt2, small_cap = _top_up_request(
+        base_text, missing_mcq, missing_sa, missing_tf, missing_idf, missing_ess, difficulty
+    )
+    raw2 = await call_groq(
+        prompt2, max_tokens_override=small_cap, system=system2,
+        make_item_check=_enough_items(missing_mcq, missing_sa, missing_tf, missing_idf, missing_ess),
+        cache_if=_has_enough_items(missing_mcq, missing_sa, missing_tf, missing_idf, missing_ess),
+    )
     arr2 = extract_json_array(raw2)
     mcq2, sa2, tf2, idf2, ess2 = _filter_and_partition(arr2)
     return _merge_trim_to_counts(mcq2, sa2, tf2, idf2, ess2, missing_mcq, missing_sa, missing_tf, missing_idf, missing_ess)
 
 def _bool_from_text(txt: str) -> bool | None:
-    t = _clean_model_output((txt or "")).strip().lower()
+    t = clean_model_output((txt or "")).strip().lower()
     # be robust if model emits anything else
     if "true" in t and "false" not in t:
         return True
@@ -711,12 +679,229 @@ def _lexical_backup(student: str, reference: str) -> bool:
     ra = _norm_text(reference).lower()
     if not sa or not ra:
         return False
-    wa = set(re.findall(r"[a-z0-9]+", sa))
-    wb = set(re.findall(r"[a-z0-9]+", ra))
+    wa = set(_WORD_RE.findall(sa))
+    wb = set(_WORD_RE.findall(ra))
     inter = len(wa & wb)
     if inter >= 3 or (wb and inter >= max(2, int(0.5 * len(wb)))):
         return True
-    return difflib.SequenceMatcher(None, sa, ra).ratio() >= 0.80
+    return fuzz.ratio(sa, ra) >= 80
+
+# ---------- Quiz response cache ----------
+QUIZ_CACHE_SIZE = int(os.getenv("QUIZ_CACHE_SIZE", "256"))
+QUIZ_CACHE_TTL_S = float(os.getenv("QUIZ_CACHE_TTL_S", "3600"))
+
+# Identical uploads with identical counts/difficulty skip the LLM round-trip entirely.
+QUIZ_CACHE = LRUCache(QUIZ_CACHE_SIZE, ttl_s=QUIZ_CACHE_TTL_S)
+
+def _quiz_cache_key(file_digest: str, mcq: int, sa: int, tf: int, idf: int, ess: int, difficulty: str) -> str:
+    return f"{file_digest}:{mcq}:{sa}:{tf}:{idf}:{ess}:{difficulty}"
+
+# Prepared (extracted + token-truncated) text per upload, so re-uploads with other counts or
+# difficulty skip parsing. Only the truncated text is kept: at most GROQ_MAX_INPUT_TOKENS each.
+EXTRACT_CACHE = LRUCache(QUIZ_CACHE_SIZE, ttl_s=float(os.getenv("EXTRACT_CACHE_TTL_S", str(7 * 86400))))
+
+# Structural tier: every validated question generated for (upload, difficulty), by type, so the
+# same material with different counts can be answered by slicing instead of calling Groq.
+QUESTION_POOL = LRUCache(QUIZ_CACHE_SIZE, ttl_s=QUIZ_CACHE_TTL_S)
+QUESTION_TYPES = ("mcq", "short_answer", "true_false", "identification", "essay")
+_POOL_MAX_PER_TYPE = 50
+
+def _pool_key(file_digest: str, difficulty: str) -> str:
+    return f"{file_digest}:{difficulty}"
+
+def _pool_add(pool_key: str, groups: Tuple[List[Dict[str, Any]], ...]):
+    pool = QUESTION_POOL.get(pool_key) or {t: [] for t in QUESTION_TYPES}
+    for t, items in zip(QUESTION_TYPES, groups):
+        bucket = pool[t]
+        seen = {it["question"] for it in bucket}
+        for it in items:
+            if len(bucket) >= _POOL_MAX_PER_TYPE:
+                break
+            if it["question"] not in seen:
+                bucket.append(it); seen.add(it["question"])
+    QUESTION_POOL.set(pool_key, pool)
+
+def _quiz_from_pool(pool_key: str, counts: Tuple[int, ...]) -> Optional[List[Dict[str, Any]]]:
+    pool = QUESTION_POOL.get(pool_key)
+    if pool is None or any(len(pool[t]) < n for t, n in zip(QUESTION_TYPES, counts)):
+        return None
+    return [it for t, n in zip(QUESTION_TYPES, counts) for it in pool[t][:n]]
+
+# ---------- Uploads ----------
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "50")) << 20
+
+async def _read_upload(file: UploadFile) -> Tuple[str, bytearray]:
+    """
+    Read the upload in chunks, hashing as it goes; no second temp file is written.
+    This buffer is a second copy of the upload (Starlette has already spooled it, in memory
+    or on disk), and _extract_text pickles a third for the worker process; MAX_UPLOAD_BYTES
+    is what bounds them.
+    Returns (sha256 hex digest, data). Raises ValueError once the upload exceeds the cap.
+    """
+    hasher = hashlib.sha256()
+    data = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        if len(data) + len(chunk) > MAX_UPLOAD_BYTES:
+            raise ValueError(f"File too large (limit {MAX_UPLOAD_BYTES >> 20} MB).")
+        hasher.update(chunk)
+        data += chunk
+    return hasher.hexdigest(), data
+
+# PDF/DOCX/PPTX parsing is CPU-bound (and python-docx/pptx are pure Python), so it runs in
+# worker processes instead of on the event loop.
+# Created on first use so spawned workers (Windows) importing this module don't start pools of their own.
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+_extract_pool: Optional[ProcessPoolExecutor] = None
+
+# truncate_text keeps at most this many characters, so parsing stops there too: a 500-page
+# PDF only has its first pages read.
+_EXTRACT_MAX_CHARS = GROQ_MAX_INPUT_TOKENS * MAX_CHARS_PER_TOKEN
+
+async def _extract_text(data: bytearray, filename: str) -> str:
+    global _extract_pool
+    if _extract_pool is None:
+        _extract_pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    pool = _extract_pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            pool, extract_text_from_bytes, data, filename, _EXTRACT_MAX_CHARS
+        )
+    except BrokenProcessPool:
+        # A parser crashed its worker (e.g. a malformed PDF); start fresh for the next upload.
+        log.error("Extraction worker died on %s; restarting the pool", filename)
+        if _extract_pool is pool:
+            _extract_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+@app.on_event("shutdown")
+def _shutdown_extract_pool():
+    if _extract_pool is not None:
+        _extract_pool.shutdown(wait=False, cancel_futures=True)
+
+# Totals at or above this start a reserve top-up in parallel with the primary call,
+# asking for roughly 20% of each requested type.
+SPECULATIVE_TOPUP_MIN_TOTAL = int(os.getenv("SPECULATIVE_TOPUP_MIN_TOTAL", "20"))
+
+def _reserve_count(need: int) -> int:
+    return max(1, int(0.2 * need)) if need else 0
+
+async def _build_quiz(
+    data: bytearray, filename: str, digest: str,
+    mcq_count: int, sa_count: int, tf_count: int, idf_count: int, ess_count: int,
+    difficulty: str,
+    pool_key: str
+) -> Tuple[int, Any]:
+    """
+    Extract -> generate -> validate -> top-up. Returns (status_code, content) so the
+    result can be shared with coalesced requests. Every valid item lands in QUESTION_POOL.
+    """
+    # Extract & prepare prompt/input (the same bytes parse the same way per extension)
+    text_key = digest + os.path.splitext(filename)[1].lower()
+    safe_text = EXTRACT_CACHE.get(text_key)
+    if safe_text is None:
+        safe_text = truncate_text(await _extract_text(data, filename))
+        EXTRACT_CACHE.set(text_key, safe_text)
+    system, prompt = generate_prompt(safe_text, mcq_count, sa_count, tf_count, idf_count, ess_count, difficulty)
+    requested_total = mcq_count + sa_count + tf_count + idf_count + ess_count
+
+    # Large quizzes routinely come back short, so a small reserve top-up runs alongside the
+    # primary call instead of after it; it is cancelled (and its budget released) if unneeded.
+    reserve = None
+    if requested_total >= SPECULATIVE_TOPUP_MIN_TOTAL:
+        reserve_counts = [_reserve_count(n) for n in (mcq_count, sa_count, tf_count, idf_count, ess_count)]
+        # Only speculate when the budget covers both calls now; otherwise the reserve would just
+        # be refused (or make the primary wait for the refill).
+        system_r, prompt_r, cap_r = _top_up_request(safe_text, *reserve_counts, difficulty)
+        both = estimate_call_tokens(prompt, GROQ_MAX_TOKENS, system) + estimate_call_tokens(prompt_r, cap_r, system_r)
+        if limiter.can_afford(both, requests=2)[0]:
+            reserve = asyncio.create_task(_top_up_generation(safe_text, 0, 0, 0, 0, 0, *reserve_counts, difficulty=difficulty))
+            # Mark a failure as retrieved: when the primary suffices nobody awaits the reserve.
+            reserve.add_done_callback(lambda t: t.cancelled() or t.exception())
+    try:
+        return await _finish_quiz(
+            safe_text, system, prompt, reserve,
+            mcq_count, sa_count, tf_count, idf_count, ess_count, difficulty, pool_key
+        )
+    finally:
+        if reserve is not None and not reserve.done():
+            reserve.cancel()
+
+async def _finish_quiz(
+    safe_text: str, system: str, prompt: str, reserve: Optional[asyncio.Task],
+    mcq_count: int, sa_count: int, tf_count: int, idf_count: int, ess_count: int,
+    difficulty: str,
+    pool_key: str
+) -> Tuple[int, Any]:
+    requested_total = mcq_count + sa_count + tf_count + idf_count + ess_count
+
+    # 1) Primary generation
+    try:
+        raw_output = await call_groq(
+            prompt, max_tokens_override=GROQ_MAX_TOKENS, system=system,
+            make_item_check=_enough_items(mcq_count, sa_count, tf_count, idf_count, ess_count),
+            cache_if=_has_enough_items(mcq_count, sa_count, tf_count, idf_count, ess_count),
+        )
+    except Exception as e:
+        log.error("Groq call failed: %s", e)
+        return 502, {"error": f"{e}"}
+
+    # 2) Strict parse
+    try:
+        arr = extract_json_array(raw_output)
+        if not isinstance(arr, list):
+            raise ValueError("Model did not return a JSON array.")
+    except Exception as e:
+        log.error("JSON parsing failed: %s\nRaw output:\n%s", e, raw_output)
+        return 500, {"error": "Failed to parse JSON from model output."}
+
+    # 3) Normalize/Repair/Validate and partition
+    mcq, sa, tf, idf, ess = _filter_and_partition(arr)
+
+    # 4) If under-produced, use the reserve first, then try ONE small top-up call for what's still missing
+    if reserve is not None:
+        if _counts_satisfied(mcq, sa, tf, idf, ess, mcq_count, sa_count, tf_count, idf_count, ess_count):
+            reserve.cancel()
+        else:
+            try:
+                ex_mcq, ex_sa, ex_tf, ex_idf, ex_ess = _filter_and_partition(await reserve)
+                mcq += ex_mcq; sa += ex_sa; tf += ex_tf; idf += ex_idf; ess += ex_ess
+            except Exception as e:
+                log.warning("Reserve top-up failed: %s", e)
+
+    if not _counts_satisfied(mcq, sa, tf, idf, ess, mcq_count, sa_count, tf_count, idf_count, ess_count):
+        try:
+            extras = await _top_up_generation(
+                base_text=safe_text,
+                have_mcq=len(mcq), have_sa=len(sa), have_tf=len(tf), have_idf=len(idf), have_ess=len(ess),
+                need_mcq=mcq_count, need_sa=sa_count, need_tf=tf_count, need_idf=idf_count, need_ess=ess_count,
+                difficulty=difficulty
+            )
+            if extras:
+                ex_mcq, ex_sa, ex_tf, ex_idf, ex_ess = _filter_and_partition(extras)
+                mcq += ex_mcq; sa += ex_sa; tf += ex_tf; idf += ex_idf; ess += ex_ess
+        except Exception as e:
+            log.warning("Top-up generation failed: %s", e)
+
+    # Keep the whole validated set (even past the requested counts, or if we end up short)
+    _pool_add(pool_key, (mcq, sa, tf, idf, ess))
+
+    # 5) Final enforcement: trim to EXACT requested counts
+    final_items = _merge_trim_to_counts(mcq, sa, tf, idf, ess, mcq_count, sa_count, tf_count, idf_count, ess_count)
+
+    # 6) If STILL short, fail loudly so the UI can retry or adjust counts
+    if len(final_items) != requested_total:
+        log.error(
+            "Final count mismatch. Have: %d (mcq=%d sa=%d tf=%d idf=%d ess=%d); need: %d",
+            len(final_items), len(mcq), len(sa), len(tf), len(idf), len(ess), requested_total
+        )
+        return 502, {"error": "Model returned fewer valid items than requested. Please retry or reduce counts."}
+
+    return 200, final_items
+
+# In-flight generations keyed like QUIZ_CACHE; followers await the leader's result.
+INFLIGHT: Dict[str, asyncio.Future] = {}
 
 # ---------- Routes ----------
 @app.get("/health")
@@ -734,98 +919,234 @@ async def generate_quiz(
     ess_count: int = Form(0),
     difficulty: str = Form("Intermediate"),
 ):
-    # Save temp upload
-    suffix = Path(file.filename).suffix or ".pdf"
-    temp_path = Path(f"temp_{uuid.uuid4()}{suffix}")
-    with temp_path.open("wb") as f:
-        f.write(await file.read())
-
+    # Unnamed/extensionless uploads have always been treated as PDFs
+    filename = file.filename or ""
+    if not os.path.splitext(filename)[1]:
+        filename += ".pdf"
     try:
-        # Extract & prepare prompt/input
-        text = extract_text_from_file(str(temp_path))
-        safe_text = truncate_text(text)
-        prompt = generate_prompt(safe_text, mcq_count, sa_count, tf_count, idf_count, ess_count, difficulty)
-        requested_total = mcq_count + sa_count + tf_count + idf_count + ess_count
-
-        # 1) Primary generation
+        digest, data = await _read_upload(file)
+    except ValueError as e:
+        return ORJSONResponse(content={"error": str(e)}, status_code=413)
+
+    cache_key = _quiz_cache_key(digest, mcq_count, sa_count, tf_count, idf_count, ess_count, difficulty)
+    cached = QUIZ_CACHE.get(cache_key)
+    if cached is not None:
+        log.info("Quiz cache hit %s", cache_key[:16])
+        return ORJSONResponse(content=cached)
+    pool_key = _pool_key(digest, difficulty)
+    pooled = _quiz_from_pool(pool_key, (mcq_count, sa_count, tf_count, idf_count, ess_count))
+    if pooled is not None:
+        log.info("Quiz pool hit %s", cache_key[:16])
+        QUIZ_CACHE.set(cache_key, pooled)
+        return ORJSONResponse(content=pooled)
+
+    # Concurrent identical requests share one pipeline run instead of each calling Groq.
+    fut = INFLIGHT.get(cache_key)
+    if fut is not None:
+        log.info("Joining in-flight generation %s", cache_key[:16])
+        status, content = await asyncio.shield(fut)
+    else:
+        fut = asyncio.get_running_loop().create_future()
+        # Mark exceptions as retrieved so an unawaited failure doesn't log a warning.
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        INFLIGHT[cache_key] = fut
         try:
-            raw_output = call_groq(prompt, max_tokens_override=GROQ_MAX_TOKENS)
+            status, content = await _build_quiz(
+                data, filename, digest, mcq_count, sa_count, tf_count, idf_count, ess_count, difficulty, pool_key
+            )
+            if status == 200:
+                QUIZ_CACHE.set(cache_key, content)
+            fut.set_result((status, content))
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
         except Exception as e:
-            log.error("Groq call failed: %s", e)
-            return JSONResponse(content={"error": f"{e}"}, status_code=502)
+            fut.set_exception(e)
+            raise
+        finally:
+            INFLIGHT.pop(cache_key, None)
 
-        # 2) Strict parse
-        try:
-            arr = extract_json_array(raw_output)
-            if not isinstance(arr, list):
-                raise ValueError("Model did not return a JSON array.")
-        except Exception as e:
-            log.error("JSON parsing failed: %s\nRaw output:\n%s", e, raw_output)
-            return JSONResponse(content={"error": "Failed to parse JSON from model output."}, status_code=500)
+    # ✅ Success returns ONLY the array; failures carry {"error": ...}
+    return ORJSONResponse(content=content, status_code=status)
 
-        # 3) Normalize/Repair/Validate and partition
-        mcq, sa, tf, idf, ess = _filter_and_partition(arr)
+# Grading instructions are static system messages; only the question/answers vary per call,
+# and they come last so provider-side prefix caching can reuse the instructions.
+_GRADE_ESSAY_SYSTEM = """You are a grader for essay questions.
 
-        # 4) If under-produced, try ONE small top-up call for missing counts
-        if not _counts_satisfied(mcq, sa, tf, idf, ess, mcq_count, sa_count, tf_count, idf_count, ess_count):
-            try:
-                extras = _top_up_generation(
-                    base_text=safe_text,
-                    have_mcq=len(mcq), have_sa=len(sa), have_tf=len(tf), have_idf=len(idf), have_ess=len(ess),
-                    need_mcq=mcq_count, need_sa=sa_count, need_tf=tf_count, need_idf=idf_count, need_ess=ess_count,
-                    difficulty=difficulty
-                )
-                if extras:
-                    ex_mcq, ex_sa, ex_tf, ex_idf, ex_ess = _filter_and_partition(extras)
-                    mcq += ex_mcq; sa += ex_sa; tf += ex_tf; idf += ex_idf; ess += ex_ess
-            except Exception as e:
-                log.warning("Top-up generation failed: %s", e)
+Evaluate if the student's essay covers the main points of the reference.
+If the student's essay addresses 40% or more of the key aspects of the reference, mark it correct.
 
-        # 5) Final enforcement: trim to EXACT requested counts
-        final_items = _merge_trim_to_counts(mcq, sa, tf, idf, ess, mcq_count, sa_count, tf_count, idf_count, ess_count)
+Output **ONLY** the word TRUE or FALSE. No punctuation. No explanation."""
 
-        # 6) If STILL short, fail loudly so the UI can retry or adjust counts
-        if len(final_items) != requested_total:
-            log.error(
-                "Final count mismatch. Have: %d (mcq=%d sa=%d tf=%d idf=%d ess=%d); need: %d",
-                len(final_items), len(mcq), len(sa), len(tf), len(idf), len(ess), requested_total
-            )
-            return JSONResponse(
-                content={"error": "Model returned fewer valid items than requested. Please retry or reduce counts."},
-                status_code=502
-            )
+_GRADE_SHORT_SYSTEM = """You are a strict grader for short-answer quizzes.
 
-        # ✅ Success – return ONLY the array
-        return JSONResponse(content=final_items)
+Evaluate if the student's answer covers the main points of the reference.
+If the student's answer addresses 40% or more of the key aspects of the reference, mark it correct.
 
-    finally:
-        try:
-            temp_path.unlink(missing_ok=True)
-        except Exception:
-            pass
+Output **ONLY** the word TRUE or FALSE. No punctuation. No explanation."""
+
+_GRADE_USER_TEMPLATE = """QUESTION: {question}
+REFERENCE: {ref}
+{label}: {student}
+
+Answer (ONLY TRUE or FALSE):"""
+
+# Batch grading: several (question, reference, student) triples per Groq call, answered as one
+# JSON array of booleans. Same 40% criterion as the single-answer prompts above.
+_GRADE_BATCH_SYSTEM = """You are a strict grader for short-answer and essay quizzes.
+
+For each numbered item, evaluate if the student's answer covers the main points of the reference.
+If the student's answer addresses 40% or more of the key aspects of the reference, mark it correct.
+
+Output **ONLY** a JSON array with one boolean per item, in item order (e.g. [true, false]). No explanation."""
+
+_GRADE_BATCH_ITEM_TEMPLATE = """#{n}
+QUESTION: {question}
+REFERENCE: {ref}
+{label}: {student}"""
+
+GRADE_BATCH_MAX_ITEMS = 200     # per HTTP request
+GRADE_BATCH_PER_CALL = 20       # per Groq call; larger batches are split and graded concurrently
+
+# Model verdicts per (question, reference, normalized answer): the same answer to the same
+# question, up to case, spacing and trailing punctuation ("Paris." vs "paris"), is graded by
+# Groq once. Signs, operators and non-Latin text stay in the key ("-5" is not "5").
+# The reference is part of the key, so editing a question's answer invalidates its entries.
+# Lexical fallbacks are not cached, so a later call can still get a model verdict.
+GRADE_CACHE = LRUCache(int(os.getenv("GRADE_CACHE_SIZE", "50000")), ttl_s=float(os.getenv("GRADE_CACHE_TTL_S", "86400")))
+
+_TRAILING_PUNCT = ".,;:!? "
+
+def _canonical_qid(raw: Any) -> Optional[str]:
+    """Canonical lowercase UUID text (how rows and cache keys spell ids), or None if invalid."""
+    try:
+        return str(uuid.UUID(str(raw)))
+    except ValueError:
+        return None
+
+def _grade_cache_key(qid: str, ref: str, student: str) -> bytes:
+    answer = _norm_text(student).casefold().rstrip(_TRAILING_PUNCT).rstrip()
+    return hashlib.sha1(f"{qid}\x1f{ref}\x1f{answer}".encode()).digest()
+
+def _identification_correct(student: str, ref: str) -> bool:
+    student_norm = _alnum_key(student)
+    ref_norm = _alnum_key(ref)
+    return bool(student_norm and ref_norm and student_norm == ref_norm)
+
+def _bool_array_of_len(raw: str, n: int) -> bool:
+    try:
+        arr = extract_json_array(raw)
+    except ValueError:
+        return False
+    return isinstance(arr, list) and len(arr) == n and all(isinstance(v, bool) for v in arr)
+
+async def _grade_batch_with_groq(triples: List[Tuple[Dict[str, Any], str, str]]) -> List[Optional[bool]]:
+    """triples: (question row, reference, student answer). None where the model gave no usable verdict."""
+    prompt = "\n\n".join(
+        _GRADE_BATCH_ITEM_TEMPLATE.format(
+            n=n, question=(row.get("text") or "").strip(), ref=ref,
+            label="STUDENT ESSAY" if row.get("type") == "essay" else "STUDENT", student=student,
+        )
+        for n, (row, ref, student) in enumerate(triples, 1)
+    ) + f"\n\nAnswer (ONLY a JSON array of {len(triples)} booleans):"
+    try:
+        raw = await call_groq(
+            prompt, max_tokens_override=8 + 3 * len(triples), system=_GRADE_BATCH_SYSTEM, temperature=GRADE_TEMPERATURE,
+            cache_if=lambda r: _bool_array_of_len(r, len(triples)),
+        )
+        verdicts = extract_json_array(raw)
+    except Exception as e:
+        log.error("Groq batch grading failed: %s", e)
+        verdicts = []
+    if len(verdicts) != len(triples):
+        return [None] * len(triples)
+    return [v if isinstance(v, bool) else None for v in verdicts]
+
+@app.post("/grade-short-answer/batch")
+async def grade_short_answer_batch(payload: dict = Body(...)):
+    """
+    Body: { "items": [ { "question_id": "<uuid>", "student_answer": "<text>" }, ... ] }
+    Returns: { "results": [ { "question_id": "<uuid>", "is_correct": true|false }, ... ] } in request order
+    Reference rows are fetched in one query; essay/short_answer items share Groq calls.
+    """
+    items = (payload or {}).get("items")
+    if not isinstance(items, list) or not items or len(items) > GRADE_BATCH_MAX_ITEMS:
+        return ORJSONResponse({"results": [], "error": "bad_request"}, status_code=400)
+    for it in items:
+        if not isinstance(it, dict) or not it.get("question_id") or not isinstance(it.get("student_answer") or "", str):
+            return ORJSONResponse({"results": [], "error": "bad_request"}, status_code=400)
+    # Rows come back keyed by the canonical lowercase UUID text, so look them up the same way
+    qids = [_canonical_qid(it["question_id"]) for it in items]
+    if None in qids:
+        return ORJSONResponse({"results": [], "error": "bad_request"}, status_code=400)
+
+    try:
+        rows = await _fetch_questions(list(set(qids)))
+    except Exception as e:
+        log.error("DB fetch failed: %s", e)
+        return ORJSONResponse({"results": [], "error": "db_error"}, status_code=500)
+
+    verdicts: List[bool] = [False] * len(items)
+    # Items that need the model, grouped by cache key so repeated answers are graded once
+    pending: Dict[bytes, List[int]] = {}
+    for i, it in enumerate(items):
+        qid = qids[i]
+        row = rows.get(qid) or {}
+        ref = (row.get("correct_answer") or "").strip()
+        student = it.get("student_answer") or ""
+        if not ref:
+            continue
+        if row.get("type") == "identification":
+            verdicts[i] = _identification_correct(student, ref)
+            continue
+        key = _grade_cache_key(qid, ref, student)
+        cached = GRADE_CACHE.get(key)
+        if cached is not None:
+            verdicts[i] = cached
+        else:
+            pending.setdefault(key, []).append(i)
+
+    keys = list(pending)
+    chunks = [keys[k:k + GRADE_BATCH_PER_CALL] for k in range(0, len(keys), GRADE_BATCH_PER_CALL)]
+    graded = await asyncio.gather(*(
+        _grade_batch_with_groq([
+            (rows[qids[i]],
+             rows[qids[i]]["correct_answer"].strip(),
+             items[i].get("student_answer") or "")
+            for i in (pending[key][0] for key in chunk)
+        ])
+        for chunk in chunks
+    ))
+    for chunk, results in zip(chunks, graded):
+        for key, val in zip(chunk, results):
+            if val is not None:
+                GRADE_CACHE.set(key, val)
+            for i in pending[key]:
+                # model replied weirdly – fall back to a cheap lexical check
+                verdicts[i] = val if val is not None else _lexical_backup(
+                    items[i].get("student_answer") or "", rows[qids[i]]["correct_answer"].strip()
+                )
+
+    return {"results": [{"question_id": it["question_id"], "is_correct": v} for it, v in zip(items, verdicts)]}
 
 @app.post("/grade-short-answer")
-def grade_short_answer(payload: dict = Body(...)):
+async def grade_short_answer(payload: dict = Body(...)):
     """
     Body: { "question_id": "<uuid>", "student_answer": "<text>" }
     Returns: { "is_correct": true|false }
     Handles: short_answer, identification, and essay types
     """
-    qid = (payload or {}).get("question_id")
+    qid = _canonical_qid((payload or {}).get("question_id") or "")
     student = (payload or {}).get("student_answer") or ""
     if not qid or not isinstance(student, str):
-        return JSONResponse({"is_correct": False, "error": "bad_request"}, status_code=400)
+        return ORJSONResponse({"is_correct": False, "error": "bad_request"}, status_code=400)
 
     # 1) get reference answer (+ optional question text) from DB
     try:
-        res = supabase.table("quiz_questions") \
-            .select("id,type,text,correct_answer") \
-            .eq("id", qid).maybe_single().execute()
-        row = (res.data if hasattr(res, "data") else res.get("data"))
-        row = row or {}
+        row = await _fetch_question(qid)
     except Exception as e:
         log.error("DB fetch failed: %s", e)
-        return JSONResponse({"is_correct": False, "error": "db_error"}, status_code=500)
+        return ORJSONResponse({"is_correct": False, "error": "db_error"}, status_code=500)
 
     question_type = row.get("type", "")
     ref = (row.get("correct_answer") or "").strip()
@@ -836,56 +1157,48 @@ def grade_short_answer(payload: dict = Body(...)):
 
     # 2) Handle identification with exact normalized matching
     if question_type == "identification":
-        def normalize_id(s: str) -> str:
-            """Remove all non-alphanumeric chars and lowercase"""
-            return re.sub(r'[^a-z0-9]', '', s.lower())
-        
-        student_norm = normalize_id(student)
-        ref_norm = normalize_id(ref)
-        
-        return {"is_correct": bool(student_norm and ref_norm and student_norm == ref_norm)}
-
-    # 3) Build grading prompt for essay/short_answer
-    if question_type == "essay":
-        prompt = f"""
-You are a grader for essay questions.
-
-Evaluate if the student's essay covers the main points of the reference.
-If the student's essay addresses 40% or more of the key aspects of the reference, mark it correct.
-
-Output **ONLY** the word TRUE or FALSE. No punctuation. No explanation.
-
-QUESTION: {question_text}
-REFERENCE: {ref}
-STUDENT ESSAY: {student}
-
-Answer (ONLY TRUE or FALSE):
-""".strip()
-    else:  # short_answer
-        prompt = f"""
-You are a strict grader for short-answer quizzes.
-
-Evaluate if the student's answer covers the main points of the reference.
-If the student's answer addresses 40% or more of the key aspects of the reference, mark it correct.
-
-Output **ONLY** the word TRUE or FALSE. No punctuation. No explanation.
-
-QUESTION: {question_text}
-REFERENCE: {ref}
-STUDENT: {student}
-
-Answer (ONLY TRUE or FALSE):
-""".strip()
+        return {"is_correct": _identification_correct(student, ref)}
+
+    # 3) Build grading prompt for essay/short_answer (unless this answer was graded before)
+    cache_key = _grade_cache_key(qid, ref, student)
+    cached = GRADE_CACHE.get(cache_key)
+    if cached is not None:
+        return {"is_correct": cached}
+    is_essay = question_type == "essay"
+    system = _GRADE_ESSAY_SYSTEM if is_essay else _GRADE_SHORT_SYSTEM
+    prompt = _GRADE_USER_TEMPLATE.format(
+        question=question_text, ref=ref, label="STUDENT ESSAY" if is_essay else "STUDENT", student=student
+    )
 
     # 3) Call Groq for grading
     try:
-        raw = call_groq(prompt, max_tokens_override=3)
+        raw = await call_groq(
+            prompt, max_tokens_override=3, system=system, temperature=GRADE_TEMPERATURE,
+            cache_if=lambda r: _bool_from_text(r) is not None,
+        )
         val = _bool_from_text(raw)
         if val is None:
             # model replied weirdly – fall back to a cheap lexical check
             val = _lexical_backup(student, ref)
+        else:
+            GRADE_CACHE.set(cache_key, val)
         return {"is_correct": bool(val)}
     except Exception as e:
         log.error("Groq grading failed: %s", e)
         # last-ditch lexical fallback so grading still works
-        return {"is_correct": _lexical_backup(student, ref)}
\ No newline at end of file
+        return {"is_correct": _lexical_backup(student, ref)}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    # "auto" selects uvloop + httptools when installed (uvicorn[standard]) and falls back on Windows.
+    # Without REDIS_URL keep a single worker: room membership and Groq budgets live in this
+    # process. With it those move to Redis, but the caches (quiz, extract, grade, Groq reply)
+    # and INFLIGHT dedup stay per-process, so each worker warms and dedups on its own.
+    uvicorn.run(
+        "main:socket_app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="auto",
+        http="auto",
+    )
@@ -0,0 +1,36 @@
+import io
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logging_setup import start_queue_logging  # noqa: E402
+
+
+class QueueLoggingTest(unittest.TestCase):
+    def setUp(self):
+        root = logging.getLogger()
+        self._saved = (root.handlers[:], root.level)
+
+    def tearDown(self):
+        root = logging.getLogger()
+        root.handlers[:] = self._saved[0]
+        root.setLevel(self._saved[1])
+
+    def test_level_prefix_is_written_once(self):
+        out = io.StringIO()
+        listener = start_queue_logging(stream=out)
+        try:
+            logging.getLogger("learnverse-backend").warning("Calling Groq model=%s", "x")
+        finally:
+            listener.stop()  # drains the queue before we read the stream
+        line = out.getvalue().strip()
+        self.assertTrue(line.endswith(" WARNING Calling Groq model=x"), line)
+        self.assertEqual(line.count("WARNING"), 1, line)
+        self.assertNotIn("learnverse-backend", line)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,40 +1,98 @@
+import io
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
 from pptx import Presentation
 import fitz  # PyMuPDF
 import docx
 
+# Corrupt PDFs can make MuPDF print long warning dumps to stderr for every page
+fitz.TOOLS.mupdf_display_errors(False)
+
+
+def _take(pieces: Iterable[str], max_chars: Optional[int]) -> List[str]:
+    """Consume pieces until they hold max_chars characters, not counting leading whitespace."""
+    if max_chars is None:
+        return list(pieces)
+    parts, total = [], 0
+    for piece in pieces:
+        parts.append(piece)
+        total += len(piece) if total else len(piece.lstrip())
+        if total >= max_chars:
+            break
+    return parts
+
+
+def _pptx_shape_texts(prs) -> Iterator[str]:
+    # One line per text shape, runs separated by spaces
+    for slide in prs.slides:
+        for shape in slide.shapes:
+            if hasattr(shape, "text") and shape.has_text_frame:
+                yield ''.join([
+                    run.text + ' '
+                    for paragraph in shape.text_frame.paragraphs
+                    for run in paragraph.runs
+                ])
+
 
-def extract_text_from_file(file_path: str) -> str:
+def extract_text_from_bytes(data, filename: str, max_chars: Optional[int] = None) -> str:
     """
-    Extract text from PDF, DOCX, PPTX, or TXT files based on file extension.
+    Extract text from a PDF, DOCX, PPTX, or TXT upload already in memory (bytes or bytearray);
+    `filename` only selects the parser by its extension.
+    With max_chars, reading stops once that much text has been collected
+    (the result may run a little past it; callers truncate precisely).
     """
-    ext = file_path.lower().split('.')[-1]
+    ext = os.path.splitext(filename)[1].lower().lstrip('.')
     text = ""
 
+    # Pieces are collected in lists and joined once; repeated `text +=` is quadratic.
     if ext == 'pdf':
-        # PDF via PyMuPDF
-        doc = fitz.open(file_path)
-        for page in doc:
-            text += page.get_text()
+        # PDF via PyMuPDF (pages stay sequential: a Document must not be shared across threads)
+        with fitz.open(stream=data, filetype='pdf') as doc:
+            text = ''.join(_take((page.get_text("text") for page in doc), max_chars))
     elif ext in ('docx', 'doc'):
         # DOCX via python-docx
-        doc = docx.Document(file_path)
-        for para in doc.paragraphs:
-            text += para.text + '\n'
+        doc = docx.Document(io.BytesIO(data))
+        text = '\n'.join(_take((para.text for para in doc.paragraphs), max_chars))
     elif ext in ('pptx', 'ppt'):
         # PPTX via python-pptx
-        prs = Presentation(file_path)
-        for slide in prs.slides:
-            for shape in slide.shapes:
-                if hasattr(shape, "text") and shape.has_text_frame:
-                    for paragraph in shape.text_frame.paragraphs:
-                        for run in paragraph.runs:
-                            text += run.text + ' '
-                    text += '\n'
+        prs = Presentation(io.BytesIO(data))
+        text = '\n'.join(_take(_pptx_shape_texts(prs), max_chars))
     elif ext == 'txt':
-        # Plain text
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            text = f.read()
+        # Plain text (newlines normalized as text-mode open() would)
+        text = data.decode('utf-8', errors='ignore').replace('\r\n', '\n').replace('\r', '\n')
     else:
         raise ValueError(f"Unsupported file extension: .{ext}")
 
     return text.strip()
+
+
+class LRUCache:
+    """
+    Small bounded in-memory cache; evicts the least recently used entry.
+    Entries older than ttl_s (when given) are treated as missing.
+    """
+    def __init__(self, maxsize: int, ttl_s: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, val = entry
+        if expires_at and time.monotonic() > expires_at:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return val
+
+    def set(self, key: str, value: Any):
+        expires_at = time.monotonic() + self.ttl_s if self.ttl_s else 0.0
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
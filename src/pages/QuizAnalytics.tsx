@@ -232,10 +232,12 @@ const QuizAnalytics = () => {
     const socket = getSocket();
     socketRef.current = socket;
 
-    // seed students on open/join (no scoring here)
+    // seed students from the open snapshot and join deltas (no scoring here)
     const seed = (payload: any) => {
       const names: string[] = Array.isArray(payload?.participants)
         ? payload.participants
+        : Array.isArray(payload?.added)
+        ? payload.added
         : [];
       setStudents((prev) => {
         const next = { ...prev };
@@ -247,7 +249,7 @@ const QuizAnalytics = () => {
     };
 
     socket.on("server:quiz-opened", seed);
-    socket.on("server:student-joined", seed);
+    socket.on("server:participants-added", seed);
 
     // scoring
     socket.on("server:answer-received", (data: any) => {
@@ -303,8 +305,6 @@ const QuizAnalytics = () => {
       });
     });
 
-    socket.on("server:client-left", seed);
-
     socket.on("server:quiz-end", () => {
       toast.success("Quiz ended");
       navigate(`/quiz/results/${id}`);
@@ -312,9 +312,8 @@ const QuizAnalytics = () => {
 
     return () => {
       socket.off("server:quiz-opened", seed);
-      socket.off("server:student-joined", seed);
+      socket.off("server:participants-added", seed);
       socket.off("server:answer-received");
-      socket.off("server:client-left", seed);
       socket.off("server:quiz-end");
     };
   }, [id, navigate]);
@@ -137,8 +137,10 @@ const QuizWaiting = () => {
     // host opens the room (once) — ONLY if canHost will be true later
     // (we don't know canHost yet on very first render; we’ll re-emit later when canHost resolves)
     return () => {
-      socket.off('server:student-joined');
-      socket.off('server:client-left');
+      socket.off('server:participants');
+      socket.off('server:quiz-opened');
+      socket.off('server:participants-added');
+      socket.off('server:participants-removed');
       socket.off('server:quiz-start');
       socket.off('server:quiz-end');
     };
@@ -150,12 +152,23 @@ const QuizWaiting = () => {
     const socket = socketRef.current;
     if (!socket) return;
 
-    // listeners
-    const onJoined = (payload: any) => {
+    // listeners: a full snapshot when we join/open, then per-join/leave deltas
+    const onParticipants = (payload: any) => {
       if (Array.isArray(payload?.participants)) setParticipants(payload.participants);
     };
-    const onLeft = (payload: any) => {
-      if (Array.isArray(payload?.participants)) setParticipants(payload.participants);
+    const onAdded = (payload: any) => {
+      if (Array.isArray(payload?.added)) setParticipants((prev) => [...prev, ...payload.added]);
+    };
+    const onRemoved = (payload: any) => {
+      if (!Array.isArray(payload?.removed)) return;
+      setParticipants((prev) => {
+        const next = [...prev];
+        payload.removed.forEach((name: string) => {
+          const i = next.indexOf(name);
+          if (i !== -1) next.splice(i, 1);
+        });
+        return next;
+      });
     };
     const onStart = (payload: any) => {
       if (payload?.section) setSection(payload.section);
@@ -181,14 +194,18 @@ const QuizWaiting = () => {
       navigate('/dashboard');
     };
 
-    socket.on('server:student-joined', onJoined);
-    socket.on('server:client-left', onLeft);
+    socket.on('server:participants', onParticipants);
+    socket.on('server:quiz-opened', onParticipants);
+    socket.on('server:participants-added', onAdded);
+    socket.on('server:participants-removed', onRemoved);
     socket.on('server:quiz-start', onStart);
     socket.on('server:quiz-end', onEnd);
 
     return () => {
-      socket.off('server:student-joined', onJoined);
-      socket.off('server:client-left', onLeft);
+      socket.off('server:participants', onParticipants);
+      socket.off('server:quiz-opened', onParticipants);
+      socket.off('server:participants-added', onAdded);
+      socket.off('server:participants-removed', onRemoved);
       socket.off('server:quiz-start', onStart);
       socket.off('server:quiz-end', onEnd);
     };
@@ -89,25 +89,29 @@ function shuffleWithSeed<T>(arr: T[], seed: number): T[] {
   return a;
 }
 
-// Call FastAPI to grade short answers (returns { is_correct: boolean })
-async function gradeShortAnswerViaBackend(
-  questionId: string,
-  student: string
-): Promise<boolean> {
+// Call FastAPI to grade all short answers/essays in one request
+// (returns { results: [{ question_id, is_correct }] } in request order)
+async function gradeShortAnswersViaBackend(
+  items: { question_id: string; student_answer: string }[]
+): Promise<Record<string, boolean>> {
+  const graded: Record<string, boolean> = {};
+  if (items.length === 0) return graded;
   try {
-    const r = await fetch(`${BACKEND_URL}/grade-short-answer`, {
+    const r = await fetch(`${BACKEND_URL}/grade-short-answer/batch`, {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({
-        question_id: questionId,
-        student_answer: student,
-      }),
+      body: JSON.stringify({ items }),
     });
     const j = await r.json();
-    return Boolean(j?.is_correct);
+    if (Array.isArray(j?.results)) {
+      j.results.forEach((res: any, i: number) => {
+        graded[items[i].question_id] = Boolean(res?.is_correct);
+      });
+    }
   } catch {
-    return false; // conservative on network error
+    // conservative on network error: missing entries count as incorrect
   }
+  return graded;
 }
 
 const MAX_LEAVE_WARNINGS = 3;
@@ -608,6 +612,17 @@ const TakeQuiz = () => {
         return;
       }
 
+      const backendGraded = await gradeShortAnswersViaBackend(
+        quizData.questions
+          .filter(
+            (q: any) =>
+              (q.type === "short_answer" || q.type === "essay") &&
+              typeof answers[q.id] === "string" &&
+              answers[q.id]
+          )
+          .map((q: any) => ({ question_id: q.id, student_answer: answers[q.id] }))
+      );
+
       const responseRows: any[] = [];
       for (const q of quizData.questions) {
         const studentAnswer = answers[q.id];
@@ -647,9 +662,8 @@ const TakeQuiz = () => {
 
           isCorrect = sa && ca && normalizeId(sa) === normalizeId(ca);
         } else {
-          // short_answer or essay: use backend grading
-          const sa = typeof studentAnswer === "string" ? studentAnswer : "";
-          isCorrect = sa ? await gradeShortAnswerViaBackend(q.id, sa) : false;
+          // short_answer or essay: graded by the backend in one batch above
+          isCorrect = backendGraded[q.id] ?? false;
         }
 
         if (isCorrect) correct++;